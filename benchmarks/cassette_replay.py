@@ -0,0 +1,100 @@
+"""Offline benchmark of the login flow and YandexQuasar against a cassette.
+
+Record once against the real API (needs an x-token, the cassette is
+scrubbed of tokens, cookies and private ids):
+
+    YANDEX_X_TOKEN=... python -m benchmarks.cassette_replay --record quasar.jsonl.gz
+
+Then replay as often as needed without network, with the recorded timings
+scaled by --speed (0 measures only our own CPU time):
+
+    python -m benchmarks.cassette_replay quasar.jsonl.gz --iterations 200 --speed 0
+"""
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from aiohttp import ClientSession
+
+from yandex_station.cassette import RecordingSession, ReplaySession
+from yandex_station.scenario_registry import ScenarioRegistry
+from yandex_station.yandex_quasar import YandexQuasar
+from yandex_station.yandex_session import YandexSession
+
+
+async def flow(session, x_token: str) -> dict:
+    """Login by x-token, CSRF, device list with scenarios, online status."""
+    timings = {}
+
+    ts = time.perf_counter()
+    yandex = YandexSession(session, x_token=x_token)
+    assert await yandex.login_token(x_token), "login failed"
+    timings['login'] = time.perf_counter() - ts
+
+    ts = time.perf_counter()
+    await yandex.refresh_csrf_token()
+    timings['csrf'] = time.perf_counter() - ts
+
+    ts = time.perf_counter()
+    quasar = YandexQuasar(yandex, ScenarioRegistry())
+    await quasar.load_devices()
+    timings['load_devices'] = time.perf_counter() - ts
+
+    ts = time.perf_counter()
+    await quasar.update_online_stats()
+    timings['online_stats'] = time.perf_counter() - ts
+
+    timings['speakers'] = len(quasar.speakers)
+    return timings
+
+
+async def record(path: str):
+    session = RecordingSession(ClientSession(), path)
+    try:
+        timings = await flow(session, os.environ['YANDEX_X_TOKEN'])
+    finally:
+        await session.close()
+    return {'recorded': len(session.entries), 'timings': timings}
+
+
+async def replay(path: str, iterations: int, speed: float) -> dict:
+    session = ReplaySession(path, speed=speed)
+    runs = [await flow(session, 'x' * 40) for _ in range(iterations)]
+
+    report = {'iterations': iterations, 'speed': speed,
+              'requests': session.served}
+    for step in ('login', 'csrf', 'load_devices', 'online_stats'):
+        values = sorted(run[step] for run in runs)
+        report[step] = {
+            'mean_ms': statistics.mean(values) * 1000,
+            'p95_ms': values[int(len(values) * 0.95)] * 1000,
+        }
+    report['speakers'] = runs[0]['speakers']
+    return report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('cassette')
+    parser.add_argument('--record', action='store_true',
+                        help='record the cassette against the real API')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--speed', type=float, default=0,
+                        help='multiplier of the recorded latencies')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if args.record:
+        report = loop.run_until_complete(record(args.cassette))
+    else:
+        report = loop.run_until_complete(
+            replay(args.cassette, args.iterations, args.speed))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Microbenchmark of fix_cloud_text against the old two-regex version.
+
+Measures the translate-table normalizer without its LRU cache (every phrase
+is new) and with it (the same phrases repeat, like in chats), on a corpus of
+short chat phrases and long messages.
+
+Usage: python -m benchmarks.cloud_text --number 2000
+"""
+import json
+import re
+import timeit
+
+from yandex_station import utils
+
+RE_LEGACY_TEXT = re.compile(r'(<.+?>|[^А-Яа-яЁёA-Za-z0-9-,!.:=? ]+)')
+RE_LEGACY_SPACE = re.compile(r'  +')
+
+CORPUS = [
+    'Привет! Как дела?',
+    'Пора ужинать 🍝🍷',
+    'Сегодня +25°C и 90% влажности, возьми зонт ☔',
+    'Café "Crème" — 5€ (дёшево)',
+    'Напомни купить молоко, хлеб; и яйца…',
+    'Їжак і ґанок',
+    'Meeting at 10:30 with @alex & #team',
+    '<speaker audio="alice-sounds-game-win-1.opus"> Победа!',
+    'Очень длинное сообщение, которое придётся резать на части. ' * 8,
+]
+
+
+def legacy_fix_cloud_text(text: str) -> str:
+    text = text.strip()
+    text = RE_LEGACY_TEXT.sub('', text)
+    text = RE_LEGACY_SPACE.sub(' ', text)
+    return text[:100]
+
+
+def uncached_fix_cloud_text(text: str) -> str:
+    # fix_cloud_text в обход lru_cache
+    text = utils.normalize_cloud_text.__wrapped__(text)
+    if len(text) > utils.CLOUD_TEXT_LIMIT:
+        # noinspection PyProtectedMember
+        text = text[:utils._cloud_cut(text, utils.CLOUD_TEXT_LIMIT)].rstrip()
+    return text
+
+
+def measure(fn, number: int) -> float:
+    """Microseconds per phrase, best of 5."""
+    timer = timeit.Timer(lambda: [fn(t) for t in CORPUS])
+    best = min(timer.repeat(repeat=5, number=number))
+    return best / number / len(CORPUS) * 1e6
+
+
+def run(number: int) -> dict:
+    # таблица заполняется при первой встрече символа, прогреваем её
+    for text in CORPUS:
+        utils.fix_cloud_text(text)
+
+    legacy = measure(legacy_fix_cloud_text, number)
+    uncached = measure(uncached_fix_cloud_text, number)
+    cached = measure(utils.fix_cloud_text, number)
+    return {
+        'phrases': len(CORPUS),
+        'legacy_us': legacy,
+        'uncached_us': uncached,
+        'cached_us': cached,
+        'uncached_speedup': legacy / uncached,
+        'cached_speedup': legacy / cached,
+        'examples': {t[:40]: utils.fix_cloud_text(t) for t in CORPUS[:8]},
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=2000,
+                        help='passes over the corpus per measurement')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.number), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Replay synthetic Telegram updates through the handler graph of main.py.
+
+No network is touched: outgoing Bot API calls are recorded by FakeBot and
+Yandex calls go to FakeStationClient with a configurable latency. The real
+dispatcher groups are used as is, including `access_check` and both
+ConversationHandlers.
+
+Reports updates per second, queue depth and per-handler latency.
+
+Usage: python -m benchmarks.dispatcher_replay --users 200 --messages 20
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+from typing import Dict, List
+
+from telegram import Update
+from telegram.bot import Bot
+from telegram.ext import Dispatcher
+
+from station_bot.profiling import iter_handlers
+
+FAKE_TOKEN = '123456:REPLAY'
+BOT_ID = 123456
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class FakeBot(Bot):
+    """Bot, который ничего не отправляет, а только записывает вызовы."""
+
+    def __init__(self):
+        super().__init__(FAKE_TOKEN)
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def _post(self, endpoint: str, data: dict = None, timeout=None,
+              api_kwargs: dict = None):
+        data = data or {}
+        with self._lock:
+            self.calls[endpoint] += 1
+            self._message_id += 1
+            message_id = self._message_id
+
+        if endpoint in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': data.get('message_id', message_id),
+                'date': int(time.time()),
+                'chat': {'id': data.get('chat_id', 0), 'type': 'private'},
+                'text': data.get('text', ''),
+            }
+        if endpoint == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Replay',
+                    'username': 'replay_bot'}
+        return True
+
+
+class FakeSpeaker:
+    def __init__(self, id: str, name: str, device_id: str):
+        self.id = id
+        self.name = name
+        self.device_id = device_id
+        self.scenario_id = 'scenario-' + id
+
+
+class FakeStationClient:
+    """Заменяет SyncCloudClient, имитируя задержку облака."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.said = 0
+        self.pending: List[concurrent.futures.Future] = []
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_token(self, username: str, password: str) -> str:
+        self._wait()
+        return 'x-token-' + username
+
+    def get_token_captcha(self, username, password, captcha, track_id):
+        return self.get_token(username, password)
+
+    def get_speakers(self, token: str) -> list:
+        self._wait()
+        return [FakeSpeaker('speaker1', 'Станция', 'device1'),
+                FakeSpeaker('speaker2', 'Мини', 'device2')]
+
+    def get_speakers_update(self, token: str, shown: list):
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def forget(self, token: str):
+        pass
+
+    def prepare_speaker(self, token: str, speaker):
+        self._wait()
+        return speaker
+
+    def say(self, token: str, speaker, phrase: str, key: str = None):
+        self._wait()
+        with self._lock:
+            self.said += 1
+
+    @staticmethod
+    def is_media_link(text: str) -> bool:
+        return False
+
+    def submit_say(self, token: str, speaker, phrase: str, user: str,
+                   key: str = None):
+        # как настоящий клиент: обработчик не ждёт облако, фраза уходит в фоне
+        future = concurrent.futures.Future()
+        self.pending.append(future)
+
+        def deliver():
+            with self._lock:
+                self.said += 1
+            future.set_result(None)
+
+        threading.Timer(self.latency, deliver).start()
+        return future
+
+    def wait(self):
+        """Ждёт фразы, отправленные через submit_say."""
+        concurrent.futures.wait(self.pending)
+
+
+class UpdateFactory:
+    """Генератор синтетических Update в JSON-формате Bot API."""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.update_id = 0
+        self.message_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"U{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{
+                'type': 'bot_command', 'offset': 0,
+                'length': len(text.split()[0])
+            }]
+        return message
+
+    def _update(self, **kwargs) -> Update:
+        self.update_id += 1
+        return Update.de_json(dict(update_id=self.update_id, **kwargs),
+                              self.bot)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._update(message=self._message(user_id, text))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        message = self._message(BOT_ID, 'Please choose:')
+        message['chat'] = {'id': user_id, 'type': 'private'}
+        return self._update(callback_query={
+            'id': str(self.update_id),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message,
+        })
+
+    def session(self, user_id: int, messages: int) -> List[Update]:
+        """Полный сценарий пользователя: авторизация, выбор колонки, текст."""
+        updates = [
+            self.text(user_id, '/start'),
+            self.text(user_id, f"user{user_id}"),
+            self.text(user_id, '123456'),
+            self.text(user_id, '/set_speaker'),
+            self.callback(user_id, 'speaker1'),
+        ]
+        updates += [self.text(user_id, f"Привет номер {i}")
+                    for i in range(messages)]
+        return updates
+
+
+def interleave(sessions: List[List[Update]], seed: int) -> List[Update]:
+    """Перемешивает сценарии, сохраняя порядок внутри каждого."""
+    rnd = random.Random(seed)
+    queues = [list(reversed(s)) for s in sessions]
+    result = []
+    while queues:
+        q = rnd.choice(queues)
+        result.append(q.pop())
+        if not q:
+            queues.remove(q)
+    return result
+
+
+class ReplayDispatcher(Dispatcher):
+    """Dispatcher, сообщающий о каждом обработанном update."""
+
+    def __init__(self, bot: Bot, on_processed):
+        super().__init__(bot, Queue(), workers=1, use_context=True)
+        self.on_processed = on_processed
+
+    def process_update(self, update: object) -> None:
+        try:
+            super().process_update(update)
+        finally:
+            self.on_processed()
+
+
+class ReplayDriver:
+    def __init__(self, main_module, bot: FakeBot):
+        self.bot = bot
+        self.dispatcher = ReplayDispatcher(bot, self._processed)
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.processed = 0
+        self.done = threading.Event()
+        self.total = 0
+
+        for group, handlers in main_module.dispatcher.handlers.items():
+            for handler in handlers:
+                for h in iter_handlers(handler):
+                    self._wrap(h)
+                self.dispatcher.add_handler(handler, group)
+
+    def _processed(self):
+        self.processed += 1
+        if self.processed >= self.total:
+            self.done.set()
+
+    def _wrap(self, handler):
+        if not hasattr(handler, 'callback') or \
+                getattr(handler.callback, '_replay_wrapped', False):
+            return
+
+        callback = handler.callback
+        name = getattr(callback, '__name__', repr(callback))
+
+        def timed(update, context):
+            ts = time.perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                self.latency[name].append(time.perf_counter() - ts)
+
+        timed._replay_wrapped = True
+        handler.callback = timed
+
+    def run(self, updates: List[Update], rate: float = 0) -> dict:
+        self.total = len(updates)
+        queue = self.dispatcher.update_queue
+        depth = []
+
+        def sample():
+            while not self.done.is_set():
+                depth.append(queue.qsize())
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=self.dispatcher.start, daemon=True)
+        thread.start()
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        ts = time.perf_counter()
+        for i, update in enumerate(updates):
+            queue.put(update)
+            if rate:
+                delay = ts + (i + 1) / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.done.wait()
+        elapsed = time.perf_counter() - ts
+        self.dispatcher.stop()
+
+        return {
+            'updates': self.total,
+            'seconds': elapsed,
+            'updates_per_second': self.total / elapsed,
+            'queue_depth': {
+                'max': max(depth, default=0),
+                'mean': statistics.mean(depth) if depth else 0,
+            },
+            'handlers': {
+                name: {
+                    'calls': len(values),
+                    'mean_ms': statistics.mean(values) * 1000,
+                    'max_ms': max(values) * 1000,
+                }
+                for name, values in sorted(self.latency.items())
+            },
+            'bot_calls': dict(self.bot.calls),
+        }
+
+
+def load_main(whitelist: str = ''):
+    """Импортирует main.py без запуска polling и без сетевых вызовов."""
+    os.environ['TELEGRAM_BOT_TOKEN'] = FAKE_TOKEN
+    os.environ['USERS_WHITELIST'] = whitelist
+    # PicklePersistence пишет рядом с рабочей директорией
+    os.chdir(tempfile.mkdtemp(prefix='replay_'))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+    import main
+    return main
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=10,
+                        help='text messages per user after the setup')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated Yandex latency per call, seconds')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='updates per second to feed, 0 - all at once')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main_module = load_main()
+    logging.getLogger().setLevel(logging.WARNING)
+    main_module.station_client = FakeStationClient(args.latency)
+
+    bot = FakeBot()
+    factory = UpdateFactory(bot)
+    sessions = [factory.session(1000 + i, args.messages)
+                for i in range(args.users)]
+    updates = interleave(sessions, args.seed)
+
+    report = ReplayDriver(main_module, bot).run(updates, args.rate)
+    main_module.station_client.wait()
+    report['said'] = main_module.station_client.said
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Fake Yandex station speaking the local Glagol protocol over wss.
+
+Each station answers every frame that carries a `conversationToken` with a
+`requestId`/`vinsResponse` reply and pushes status frames on its own, like a
+real station in the playing mode. The extra `fakeDrop` command closes the
+connection so a harness can inject disconnects.
+"""
+import asyncio
+import json
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+from typing import List, Optional
+
+from aiohttp import WSMsgType, web
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def make_ssl_context(cert_dir: str = None) -> ssl.SSLContext:
+    """Создаёт самоподписанный сертификат через openssl."""
+    cert_dir = cert_dir or tempfile.mkdtemp(prefix='fake_glagol_')
+    cert = os.path.join(cert_dir, 'cert.pem')
+    key = os.path.join(cert_dir, 'key.pem')
+    if not os.path.isfile(cert):
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key, '-out', cert, '-days', '1',
+            '-subj', '/CN=localhost'
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class FakeGlagolStation:
+    """Одна фейковая колонка на своём порту."""
+    runner: Optional[web.AppRunner] = None
+
+    def __init__(self, device_id: str, port: int, host: str = '127.0.0.1',
+                 status_interval: float = 1.0, response_delay: float = 0):
+        self.device_id = device_id
+        self.host = host
+        self.port = port
+        self.status_interval = status_interval
+        self.response_delay = response_delay
+
+        self.sockets: List[web.WebSocketResponse] = []
+        self.received = 0
+        self.connections = 0
+
+    @property
+    def device(self) -> dict:
+        """Описание устройства в формате, который ждёт YandexGlagol."""
+        return {
+            'name': f"Fake {self.device_id}",
+            'host': self.host,
+            'port': self.port,
+            'quasar_info': {
+                'device_id': self.device_id,
+                'platform': 'fake'
+            }
+        }
+
+    async def start(self, ssl_context: ssl.SSLContext):
+        app = web.Application()
+        app.router.add_get('/', self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port,
+                           ssl_context=ssl_context)
+        await site.start()
+
+    async def stop(self):
+        await self.drop()
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def drop(self):
+        """Рвёт все текущие подключения, имитируя перезагрузку колонки."""
+        for ws in list(self.sockets):
+            await ws.close()
+
+    def state(self) -> dict:
+        return {
+            'state': {
+                'aliceState': 'IDLE',
+                'playing': True,
+                'volume': 0.5,
+                'playerState': {
+                    'title': 'Fake track',
+                    'subtitle': self.device_id,
+                    'duration': 180,
+                    'progress': time.time() % 180,
+                }
+            },
+            'sentTime': int(round(time.time() * 1000)),
+        }
+
+    async def _handle(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        self.sockets.append(ws)
+        self.connections += 1
+        pusher = asyncio.create_task(self._push_status(ws))
+
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+
+                data = json.loads(msg.data)
+                if 'conversationToken' not in data:
+                    continue
+
+                self.received += 1
+                if data.get('payload', {}).get('command') == 'fakeDrop':
+                    # команда стенда: имитируем обрыв связи
+                    await ws.close()
+                    break
+
+                if self.response_delay:
+                    await asyncio.sleep(self.response_delay)
+
+                resp = self.state()
+                resp['requestId'] = data.get('id')
+                resp['vinsResponse'] = {
+                    'response': {
+                        'card': {'type': 'simple_text', 'text': 'ok'}
+                    }
+                }
+                await ws.send_json(resp)
+        finally:
+            pusher.cancel()
+            self.sockets.remove(ws)
+
+        return ws
+
+    async def _push_status(self, ws: web.WebSocketResponse):
+        try:
+            while not ws.closed:
+                await ws.send_json(self.state())
+                await asyncio.sleep(self.status_interval)
+        except (ConnectionResetError, RuntimeError):
+            pass
+
+
+class FakeGlagolFleet:
+    """Набор фейковых колонок на последовательных портах."""
+
+    def __init__(self, count: int, base_port: int = 19610,
+                 status_interval: float = 1.0, response_delay: float = 0):
+        self.stations = [
+            FakeGlagolStation(f"fake{i:05d}", base_port + i,
+                              status_interval=status_interval,
+                              response_delay=response_delay)
+            for i in range(count)
+        ]
+
+    async def start(self):
+        context = make_ssl_context()
+        await asyncio.gather(*[s.start(context) for s in self.stations])
+        _LOGGER.info(f"Started {len(self.stations)} fake stations")
+
+    async def stop(self):
+        await asyncio.gather(*[s.stop() for s in self.stations])
+
+
+async def main(count: int, base_port: int, status_interval: float = 1.0,
+               response_delay: float = 0):
+    fleet = FakeGlagolFleet(count, base_port, status_interval, response_delay)
+    await fleet.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fleet.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--base-port', type=int, default=19610)
+    parser.add_argument('--status-interval', type=float, default=1.0)
+    parser.add_argument('--response-delay', type=float, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main(args.count, args.base_port, args.status_interval,
+                         args.response_delay))
+    except KeyboardInterrupt:
+        pass
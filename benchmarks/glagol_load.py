@@ -0,0 +1,233 @@
+"""Load harness for YandexGlagol against a fleet of fake stations.
+
+Runs the fake stations in a child process so the numbers below belong to the
+client side only:
+
+- CPU seconds per connection per second of steady state;
+- memory per connection (Python heap via tracemalloc and process RSS);
+- send round-trip times;
+- reconnect times after injected disconnects.
+
+Usage: python -m benchmarks.glagol_load --count 300
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession
+
+from yandex_station.yandex_glagol import YandexGlagol
+from . import fake_glagol
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class FakeResponse:
+    def __init__(self, data: dict):
+        self.status = 200
+        self._data = data
+
+    async def json(self):
+        return self._data
+
+
+class LocalSession:
+    """Минимальная замена YandexSession: токен устройства выдаётся локально,
+    websocket идёт в настоящую aiohttp-сессию.
+    """
+
+    def __init__(self, session: ClientSession):
+        self.session = session
+        self.token_requests = 0
+
+    async def get(self, url, **kwargs):
+        self.token_requests += 1
+        return FakeResponse({'status': 'ok', 'token': 'fake-device-token'})
+
+    async def ws_connect(self, *args, **kwargs):
+        return await self.session.ws_connect(*args, **kwargs)
+
+
+class Probe:
+    """Следит за состоянием одного подключения через update_handler."""
+
+    def __init__(self, glagol: YandexGlagol):
+        self.glagol = glagol
+        self.online = asyncio.Event()
+        self.dropped_at: Optional[float] = None
+        self.offline_seen = False
+        self.reconnects: List[float] = []
+        self.updates = 0
+        glagol.update_handler = self.handle
+
+    async def handle(self, data: Optional[dict]):
+        if data is None:
+            self.online.clear()
+            self.offline_seen = True
+            return
+
+        self.updates += 1
+        # статус, пришедший до фактического обрыва, не считается
+        if self.dropped_at is not None and self.offline_seen:
+            self.reconnects.append(time.perf_counter() - self.dropped_at)
+            self.dropped_at = None
+        self.online.set()
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        'min': values[0],
+        'p50': values[len(values) // 2],
+        'p95': values[int(len(values) * 0.95)],
+        'p99': values[int(len(values) * 0.99)],
+        'max': values[-1],
+        'mean': statistics.mean(values),
+    }
+
+
+def run_fleet(count: int, base_port: int, status_interval: float):
+    asyncio.run(fake_glagol.main(count, base_port, status_interval))
+
+
+async def wait_online(probes: List[Probe], timeout: float):
+    await asyncio.wait_for(
+        asyncio.gather(*[p.online.wait() for p in probes]), timeout)
+
+
+async def measure_rtt(probes: List[Probe], rounds: int) -> List[float]:
+    async def one(probe: Probe):
+        result = []
+        for _ in range(rounds):
+            ts = time.perf_counter()
+            resp = await probe.glagol.send({'command': 'ping'})
+            if resp is not None:
+                result.append(time.perf_counter() - ts)
+        return result
+
+    results = await asyncio.gather(*[one(p) for p in probes])
+    return [rtt for r in results for rtt in r]
+
+
+async def inject_disconnects(probes: List[Probe], timeout: float) -> dict:
+    for probe in probes:
+        probe.offline_seen = False
+        probe.dropped_at = time.perf_counter()
+        await probe.glagol.ws.send_json({
+            'conversationToken': probe.glagol.device_token,
+            'id': 'drop',
+            'payload': {'command': 'fakeDrop'},
+        })
+
+    # ждём переподключения, статус придёт сам не позже status_interval
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all(p.dropped_at is None for p in probes):
+            break
+        await asyncio.sleep(0.1)
+
+    times = [t for p in probes for t in p.reconnects]
+    return {
+        'reconnected': len(times),
+        'lost': sum(1 for p in probes if p.dropped_at is not None),
+        'seconds': percentiles(times),
+    }
+
+
+async def run(count: int, base_port: int, steady: float,
+              rounds: int) -> dict:
+    tracemalloc.start()
+
+    async with ClientSession() as session:
+        local = LocalSession(session)
+        heap_before = tracemalloc.get_traced_memory()[0]
+        rss_before = rss_bytes()
+
+        ts = time.perf_counter()
+        probes = []
+        for i in range(count):
+            device = fake_glagol.FakeGlagolStation(
+                f"fake{i:05d}", base_port + i).device
+            probe = Probe(YandexGlagol(local, device))
+            probes.append(probe)
+            await probe.glagol.start_or_restart()
+
+        await wait_online(probes, timeout=30 + count / 10)
+        connect_time = time.perf_counter() - ts
+
+        heap_after = tracemalloc.get_traced_memory()[0]
+        rss_after = rss_bytes()
+        tracemalloc.stop()
+
+        cpu = time.process_time()
+        await asyncio.sleep(steady)
+        cpu = time.process_time() - cpu
+
+        rtt = await measure_rtt(probes, rounds)
+        reconnect = await inject_disconnects(probes, timeout=30)
+
+        for probe in probes:
+            await probe.glagol.stop()
+
+    return {
+        'connections': count,
+        'connect_seconds': connect_time,
+        'cpu_per_connection_per_second': cpu / steady / count,
+        'heap_bytes_per_connection': (heap_after - heap_before) / count,
+        'rss_bytes_per_connection': (rss_after - rss_before) / count,
+        'updates_per_connection': statistics.mean(p.updates for p in probes),
+        'send_rtt_seconds': percentiles(rtt),
+        'reconnect': reconnect,
+        'device_token_requests': local.token_requests,
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--base-port', type=int, default=19610)
+    parser.add_argument('--steady', type=float, default=10,
+                        help='seconds of steady state for the CPU sample')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='sends per connection for the RTT sample')
+    parser.add_argument('--status-interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    fleet = multiprocessing.Process(
+        target=run_fleet,
+        args=(args.count, args.base_port, args.status_interval),
+        daemon=True)
+    fleet.start()
+    # даём колонкам подняться
+    time.sleep(2 + args.count / 200)
+
+    try:
+        report = asyncio.run(run(args.count, args.base_port, args.steady,
+                                 args.rounds))
+        print(json.dumps(report, indent=2))
+    finally:
+        fleet.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Microbenchmarks of the pure helpers that run on every message or device
+refresh, with a baseline comparison.
+
+Save a baseline on the commit you compare against, then compare a change
+with it; the run exits with 1 if any benchmark got slower than --threshold:
+
+    python -m benchmarks.hot_paths --save hot_paths.json
+    python -m benchmarks.hot_paths --compare hot_paths.json --threshold 1.2
+
+Every benchmark is timed --repeat times, in rounds over all of them, so a
+slow moment of the machine spreads over the whole set instead of hitting
+one benchmark. Medians are compared, and the threshold grows with the
+spread of the samples, so a noisy benchmark needs a bigger slowdown to
+count as a regression.
+
+Timings are machine dependent, so the baseline is not kept in the repo.
+"""
+import json
+import random
+import statistics
+import sys
+import timeit
+import uuid
+from typing import Callable, Dict, List, Union
+
+from yandex_station import utils
+from yandex_station.yandex_quasar import YandexQuasar, decode, encode
+
+WORDS = (
+    'привет как дела сегодня завтра погода на улице холодно тепло дождь '
+    'снег ужин готов купить молоко хлеб встреча перенесена позвони маме '
+    'напоминаю что через пять минут начинается фильм не забудь зонт'
+).split()
+EXTRAS = ['😀', '🍝', '+25°C', '90%', '«цитата»', '—', 'Café', '(скобки)',
+          '\n', '№5', '10:30', '&', '…']
+LINKS = [
+    'https://youtu.be/dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42',
+    'https://music.yandex.ru/album/123/track/456',
+    'https://music.yandex.ru/users/alexey.khit/playlists/1000',
+    'https://www.kinopoisk.ru/film/326/',
+    'https://vk.com/video-12345_678',
+    'https://yandex.ru/efir?stream_id=4a2b3c',
+]
+DEVICE_TYPES = [
+    'devices.types.smart_speaker.yandex.station',
+    'devices.types.smart_speaker.yandex.station.mini',
+    'devices.types.media_device.dongle.yandex.module',
+    'devices.types.light',
+    'devices.types.socket',
+    'devices.types.thermostat.ac',
+    'devices.types.media_device.tv',
+    'devices.types.sensor',
+]
+# во сколько раз относительный разброс замеров увеличивает порог
+NOISE_SCALE = 2
+
+
+def text_corpus(rnd: random.Random, count: int, words: int) -> List[str]:
+    texts = []
+    for _ in range(count):
+        parts = [rnd.choice(WORDS) for _ in range(words)]
+        for _ in range(words // 8):
+            parts.insert(rnd.randrange(len(parts)), rnd.choice(EXTRAS))
+        texts.append(' '.join(parts).capitalize() + '.')
+    return texts
+
+
+def link_corpus(rnd: random.Random, count: int) -> List[str]:
+    # половина сообщений без ссылок, как в обычном чате
+    texts = text_corpus(rnd, count, 12)
+    for i in range(0, count, 2):
+        texts[i] = f"{texts[i]} {rnd.choice(LINKS)}"
+    return texts
+
+
+def device_corpus(rnd: random.Random, count: int) -> List[dict]:
+    devices = []
+    for i in range(count):
+        device = {
+            'id': str(uuid.UUID(int=rnd.getrandbits(128))),
+            'name': f"Устройство {i}",
+            'type': rnd.choice(DEVICE_TYPES),
+            'capabilities': [{'type': 'devices.capabilities.on_off'}] * 3,
+        }
+        if 'yandex' in device['type']:
+            device['quasar_info'] = {'device_id': f"{i:024X}",
+                                     'platform': 'yandexstation'}
+        devices.append(device)
+    return devices
+
+
+def build() -> Dict[str, Callable]:
+    rnd = random.Random(42)
+    short_texts = text_corpus(rnd, 200, 10)
+    long_texts = text_corpus(rnd, 50, 120)
+    links = link_corpus(rnd, 200)
+    devices = device_corpus(rnd, 150)
+    uids = [d['id'] for d in devices]
+    names = [encode(u) for u in uids]
+    quasar = YandexQuasar(None)
+
+    def fix_cold():
+        # пустые и lru_cache, и таблицы замен символов
+        utils.normalize_cloud_text.cache_clear()
+        utils.CLOUD_TABLE.clear()
+        utils.CLOUD_RUNS.clear()
+        for text in short_texts:
+            utils.fix_cloud_text(text)
+
+    def fix_warm():
+        for text in short_texts:
+            utils.fix_cloud_text(text)
+
+    def split_long():
+        utils.normalize_cloud_text.cache_clear()
+        for text in long_texts:
+            utils.split_cloud_text(text)
+
+    def encode_uids():
+        for uid in uids:
+            encode(uid)
+
+    def decode_names():
+        for name in names:
+            decode(name)
+
+    def speakers_from_devices():
+        quasar.get_speakers_from_devices(devices)
+
+    def update_forms():
+        for text in short_texts:
+            utils.update_form('personal_assistant.scenarios.repeat_after_me',
+                              request=text)
+
+    def match_links():
+        for text in links:
+            utils.match_media(text)
+
+    return {
+        'fix_cloud_text.cold[200 short]': fix_cold,
+        'fix_cloud_text.warm[200 short]': fix_warm,
+        'split_cloud_text[50 long]': split_long,
+        'encode[150 uids]': encode_uids,
+        'decode[150 names]': decode_names,
+        'get_speakers_from_devices[150 devices]': speakers_from_devices,
+        'update_form[200]': update_forms,
+        'match_media[200 mixed]': match_links,
+    }
+
+
+def calibrate(fn: Callable) -> timeit.Timer:
+    timer = timeit.Timer(fn)
+    timer.number, _ = timer.autorange()
+    return timer
+
+
+def run(repeat: int) -> Dict[str, List[float]]:
+    """Microseconds per call, `repeat` samples of every benchmark taken in
+    rounds over all of them.
+    """
+    timers = {name: calibrate(fn) for name, fn in build().items()}
+    samples = {name: [] for name in timers}
+    for _ in range(repeat):
+        for name, timer in timers.items():
+            seconds = timer.timeit(timer.number)
+            samples[name].append(seconds / timer.number * 1e6)
+    return samples
+
+
+def summary(samples: Union[List[float], float]):
+    """Median and relative spread (median absolute deviation / median)."""
+    if isinstance(samples, (int, float)):
+        # старый формат базы: одно лучшее значение
+        return samples, 0.0
+    median = statistics.median(samples)
+    mad = statistics.median(abs(x - median) for x in samples)
+    return median, mad / median if median else 0.0
+
+
+def compare(results: Dict[str, List[float]], baseline: Dict[str, List[float]],
+            threshold: float) -> List[str]:
+    regressions = []
+    for name, samples in results.items():
+        value, noise = summary(samples)
+        ratio_text, limit_text, mark = 'new', '', ''
+        if name in baseline:
+            base, base_noise = summary(baseline[name])
+            ratio = value / base
+            limit = threshold + NOISE_SCALE * (noise + base_noise)
+            if ratio > limit:
+                mark = '  REGRESSION'
+                regressions.append(name)
+            ratio_text, limit_text = f"{ratio:.2f}x", f"<{limit:.2f}x"
+        print(f"{name:45} {value:10.1f}us ±{noise:4.0%} "
+              f"{ratio_text:>8} {limit_text:>7}{mark}")
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--save', metavar='PATH', help='write results here')
+    parser.add_argument('--compare', metavar='PATH', help='baseline to compare')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='allowed slowdown ratio against the baseline')
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold}x")
+            sys.exit(1)
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
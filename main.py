@@ -1,6 +1,14 @@
+# first of all, so the startup metrics include the imports below
+from station_bot.startup import STARTED_AT
+
+import datetime
+import hashlib
 import logging
 import os
+import re
+import time
 
+import pytz
 from dotenv import load_dotenv
 from telegram import (
     InlineKeyboardButton,
@@ -9,7 +17,7 @@ from telegram import (
     InputTextMessageContent,
     Update,
 )
-from telegram.bot import Bot, BotCommand
+from telegram.bot import BotCommand
 from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
@@ -18,13 +26,24 @@ from telegram.ext import (
     Filters,
     InlineQueryHandler,
     MessageHandler,
-    PicklePersistence,
     TypeHandler,
     Updater,
 )
+from station_bot.dedup import UpdateDeduplicator
+from station_bot.nowplaying import NowPlayingNotifier
+from station_bot.persistence import LockedPicklePersistence
+from station_bot.profiling import UpdateProfiler
+from yandex_station import tracing
+from yandex_station.outbox import Outbox
+from yandex_station.scheduler import JobStore
 from yandex_station.station_client_cloud import (
     CaptchaRequiredException,
+    MediaNotSupportedException,
+    PhraseTooLongException,
+    SpeakerOfflineException,
+    StationNotReachableException,
     SyncCloudClient,
+    UserBusyException,
     WrongPasswordException,
 )
 
@@ -32,8 +51,12 @@ _LOGGER = logging.getLogger(__name__)
 
 load_dotenv()
 botToken = os.environ.get("TELEGRAM_BOT_TOKEN")
+# state that must survive a container being recreated, see docker-compose.yml
+DATA_DIR = os.environ.get("DATA_DIR", ".")
 
-my_persistence = PicklePersistence(filename="bot_data.bin")
+my_persistence = LockedPicklePersistence(
+    filename=os.path.join(DATA_DIR, "bot_data.bin")
+)
 updater = Updater(token=botToken, persistence=my_persistence, use_context=True)
 dispatcher = updater.dispatcher
 whitelist = os.environ.get("USERS_WHITELIST")
@@ -41,14 +64,24 @@ if not whitelist:
     whitelist = []
 else:
     whitelist = whitelist.split(",")
+admins = os.environ.get("ADMIN_USERS")
+admins = admins.split(",") if admins else []
 
 command = [
     BotCommand("start", "get user yandex token"),
     BotCommand("set_speaker", "choose yandex station"),
+    BotCommand("broadcast", "say a phrase on the chosen stations"),
+    BotCommand("broadcast_to", "choose stations for /broadcast"),
+    BotCommand("remind", "say a phrase on the station later"),
+    BotCommand("reminders", "list your reminders"),
+    BotCommand("cancel_reminder", "delete a reminder"),
+    BotCommand("volume", "change the volume: /volume +2, /volume -1 or /volume 5"),
+    BotCommand("pause", "pause the station, /pause off to resume"),
+    BotCommand("mute", "mute the station, /mute off to unmute"),
+    BotCommand("dnd", "do not disturb mode: /dnd on or /dnd off"),
+    BotCommand("nowplaying", "show what the station plays, /nowplaying off to stop"),
     BotCommand("delete_my_data", "delete user information"),
 ]
-bot = Bot(botToken)
-bot.set_my_commands(command)
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -74,9 +107,78 @@ def access_check(update, context):
     return
 
 
+# updates are redelivered after restarts and webhook retries
+# and kept per bot, a new token starts a new update_id sequence
+dedup = UpdateDeduplicator(
+    os.environ.get("DEDUP_STATE_PATH", os.path.join(DATA_DIR, "update_hwm.json")),
+    bot_id=int(botToken.split(":")[0]),
+)
+dedup.install(dispatcher)
+
 access_check_handler = TypeHandler(Update, access_check)
 dispatcher.add_handler(access_check_handler, 0)
 
+startup_metrics = {}
+
+# head-based sampling: the decision is made once per update
+tracing.configure(
+    os.environ.get("TRACE_PATH", "traces.jsonl"),
+    float(os.environ.get("TRACE_SAMPLE_RATE", 0)),
+)
+
+
+def traced(process_update):
+    """The root span of an update around the whole dispatch, including
+    dedup. A finally and not a late handler group: DispatcherHandlerStop
+    from dedup or access_check skips the groups after it.
+    """
+
+    def process(update):
+        if not isinstance(update, Update):
+            return process_update(update)
+
+        tracing.start_trace(
+            "update",
+            update_id=update.update_id,
+            user=update.effective_user.id if update.effective_user else None,
+        )
+        try:
+            return process_update(update)
+        finally:
+            tracing.end_trace()
+
+    return process
+
+
+dispatcher.process_update = traced(dispatcher.process_update)
+
+
+def record_first_update(update, context):
+    if "first_update_s" not in startup_metrics:
+        startup_metrics["first_update_s"] = time.monotonic() - STARTED_AT
+        _LOGGER.info(f"First update in {startup_metrics['first_update_s']:.2f}s")
+
+
+# before the profiler and access_check, a group runs only one handler
+dispatcher.add_handler(TypeHandler(Update, record_first_update), -10)
+
+
+def sync_commands():
+    """Calls set_my_commands only when the command list has changed."""
+    ts = time.monotonic()
+    digest = hashlib.sha1(
+        repr(
+            [botToken.split(":")[0]] + [(c.command, c.description) for c in command]
+        ).encode()
+    ).hexdigest()
+    if dispatcher.bot_data.get("bot_commands_hash") != digest:
+        updater.bot.set_my_commands(command)
+        # runs in a worker thread while the dispatcher may be copying bot_data
+        with my_persistence.lock:
+            dispatcher.bot_data["bot_commands_hash"] = digest
+    startup_metrics["commands_sync_s"] = time.monotonic() - ts
+
+
 YANDEX_AUTH_USERNAME, YANDEX_AUTH_PASSWORD, YANDEX_AUTH_CAPTCHA = range(3)
 
 
@@ -213,10 +315,29 @@ def start_station_choosing(update, context):
         "The command /cancel_station_choosing is to stop the conversation."
     )
 
-    list_of_speakers = station_client.get_speakers(
-        context.user_data["yandex_auth_token"]
+    token = context.user_data["yandex_auth_token"]
+    list_of_speakers = station_client.get_speakers(token)
+
+    reply_markup, dict_of_station_config = build_station_keyboard(list_of_speakers)
+    context.user_data["dict_of_station_config"] = dict_of_station_config
+
+    message = update.message.reply_text("Please choose:", reply_markup=reply_markup)
+
+    # the list may come from a stale cache, fix the keyboard when it is refreshed
+    def on_speakers_update(future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            context.dispatcher.run_async(
+                update_station_keyboard, context, message, future.result()
+            )
+
+    station_client.get_speakers_update(token, list_of_speakers).add_done_callback(
+        on_speakers_update
     )
 
+    return YANDEX_CHOOSING_STATION
+
+
+def build_station_keyboard(list_of_speakers):
     inline_keyboard_list = []
     dict_of_station_config = {}
 
@@ -228,13 +349,17 @@ def start_station_choosing(update, context):
         dict_of_station_config[elem.id] = elem
 
     keyboard = [inline_keyboard_list]
+    return InlineKeyboardMarkup(keyboard), dict_of_station_config
 
-    context.user_data["dict_of_station_config"] = dict_of_station_config
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Please choose:", reply_markup=reply_markup)
+def update_station_keyboard(context, message, list_of_speakers):
+    # the user has already chosen or cancelled
+    if "dict_of_station_config" not in context.user_data:
+        return
 
-    return YANDEX_CHOOSING_STATION
+    reply_markup, dict_of_station_config = build_station_keyboard(list_of_speakers)
+    context.user_data["dict_of_station_config"] = dict_of_station_config
+    message.edit_reply_markup(reply_markup=reply_markup)
 
 
 def choose_station(update, context):
@@ -275,7 +400,9 @@ def cancel_station_choosing(update, context):
 choosing_station_conv_handler = ConversationHandler(
     entry_points=[CommandHandler("set_speaker", start_station_choosing)],
     states={
-        YANDEX_CHOOSING_STATION: [CallbackQueryHandler(choose_station)],
+        YANDEX_CHOOSING_STATION: [
+            CallbackQueryHandler(choose_station, pattern=r"^(?!broadcast:)")
+        ],
     },
     fallbacks=[CommandHandler("cancel_station_choosing", cancel_station_choosing)],
     allow_reentry=True,
@@ -283,6 +410,10 @@ choosing_station_conv_handler = ConversationHandler(
 dispatcher.add_handler(choosing_station_conv_handler, 1)
 
 
+# long messages are spoken in up to 5 commands of 100 characters
+TOO_LONG_TEXT = "The message is too long, a station can say up to about 500 characters."
+
+
 def say_via_alice(update, context):
     if context.user_data.get("yandex_auth_token") is None:
         update.message.reply_text(
@@ -296,17 +427,455 @@ def say_via_alice(update, context):
         )
         return
 
-    station_client.say(
+    if station_client.is_media_link(update.message.text):
+        play_media(update, context)
+        return
+
+    try:
+        future = station_client.submit_say(
+            context.user_data["yandex_auth_token"],
+            context.user_data["selected_yandex_speaker"],
+            update.message.text,
+            user=str(update.effective_user.id),
+            key=str(update.update_id),
+        )
+    except UserBusyException:
+        update.message.reply_text(
+            "I'm busy with your previous messages. Please wait a bit and try again."
+        )
+        return
+
+    def on_said(future):
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), SpeakerOfflineException):
+            context.dispatcher.run_async(
+                update.message.reply_text,
+                "Your station is offline now. Check its connection or use /set_speaker to choose another one.",
+            )
+        elif isinstance(future.exception(), PhraseTooLongException):
+            context.dispatcher.run_async(update.message.reply_text, TOO_LONG_TEXT)
+        elif future.exception():
+            _LOGGER.warning(f"Say failed: {future.exception()!r}")
+
+    future.add_done_callback(on_said)
+
+
+def play_media(update, context):
+    future = station_client.play_media(
         context.user_data["yandex_auth_token"],
         context.user_data["selected_yandex_speaker"],
         update.message.text,
     )
 
+    def on_played(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, MediaNotSupportedException):
+            text = "Links can be played only when the bot is in the same local network as your station."
+        elif isinstance(error, ValueError):
+            text = "Sorry, I could not open this link."
+        elif error:
+            _LOGGER.warning(f"Play failed: {error!r}")
+            text = "Sorry, your station did not start playing. Please try again later."
+        else:
+            return
+        context.dispatcher.run_async(update.message.reply_text, text)
+
+    future.add_done_callback(on_played)
+
 
 say_via_alice_handler = MessageHandler(Filters.text & (~Filters.command), say_via_alice)
 dispatcher.add_handler(say_via_alice_handler, 1)
 
 
+def broadcast(update, context):
+    if context.user_data.get("yandex_auth_token") is None:
+        update.message.reply_text(
+            "Sorry, you have not authorized yet. Use /start to start our work."
+        )
+        return
+
+    phrase = " ".join(context.args)
+    if not phrase:
+        update.message.reply_text("Usage: /broadcast <phrase>")
+        return
+
+    chosen = context.user_data.get("broadcast_speakers")
+    if not chosen:
+        update.message.reply_text(
+            "Choose the stations first. Use /broadcast_to to choose them."
+        )
+        return
+
+    try:
+        future = station_client.submit_broadcast(
+            context.user_data["yandex_auth_token"],
+            list(chosen.values()),
+            phrase,
+            user=str(update.effective_user.id),
+        )
+    except UserBusyException:
+        update.message.reply_text(
+            "I'm busy with your previous messages. Please wait a bit and try again."
+        )
+        return
+
+    def on_broadcast(future):
+        if future.cancelled() or future.exception() is None:
+            return
+        if isinstance(future.exception(), SpeakerOfflineException):
+            text = "All the chosen stations are offline now."
+        elif isinstance(future.exception(), PhraseTooLongException):
+            text = TOO_LONG_TEXT
+        else:
+            _LOGGER.warning(f"Broadcast failed: {future.exception()!r}")
+            text = "Sorry, I could not broadcast the phrase."
+        context.dispatcher.run_async(update.message.reply_text, text)
+
+    future.add_done_callback(on_broadcast)
+
+
+def build_broadcast_keyboard(list_of_speakers, chosen):
+    keyboard = []
+    for elem in list_of_speakers:
+        mark = "✅ " if elem.id in chosen else ""
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    mark + elem.name, callback_data="broadcast:" + elem.id
+                )
+            ]
+        )
+    return InlineKeyboardMarkup(keyboard)
+
+
+def broadcast_to(update, context):
+    if context.user_data.get("yandex_auth_token") is None:
+        update.message.reply_text(
+            "Sorry, you have not authorized yet. Use /start to start our work."
+        )
+        return
+
+    list_of_speakers = station_client.get_speakers(
+        context.user_data["yandex_auth_token"]
+    )
+    chosen = context.user_data.get("broadcast_speakers", {})
+    update.message.reply_text(
+        "Tap the stations that /broadcast should speak on:",
+        reply_markup=build_broadcast_keyboard(list_of_speakers, chosen),
+    )
+
+
+def toggle_broadcast_speaker(update, context):
+    query = update.callback_query
+    query.answer()
+    if context.user_data.get("yandex_auth_token") is None:
+        return
+
+    list_of_speakers = station_client.get_speakers(
+        context.user_data["yandex_auth_token"]
+    )
+    chosen = context.user_data.setdefault("broadcast_speakers", {})
+    speaker_id = query.data.split(":", 1)[1]
+    if speaker_id in chosen:
+        del chosen[speaker_id]
+    else:
+        chosen.update({s.id: s for s in list_of_speakers if s.id == speaker_id})
+
+    query.edit_message_reply_markup(
+        reply_markup=build_broadcast_keyboard(list_of_speakers, chosen)
+    )
+
+
+broadcast_handler = CommandHandler("broadcast", broadcast)
+dispatcher.add_handler(broadcast_handler, 1)
+dispatcher.add_handler(CommandHandler("broadcast_to", broadcast_to), 1)
+dispatcher.add_handler(
+    CallbackQueryHandler(toggle_broadcast_speaker, pattern=r"^broadcast:"), 1
+)
+
+
+REMIND_USAGE = (
+    "Usage:\n"
+    "/remind 18:00 <phrase> - once at the given time\n"
+    "/remind daily 08:30 <phrase> - every day\n"
+    "/remind every 30m <phrase> - every N minutes (m) or hours (h)"
+)
+# the container clock is UTC, reminder times are read in the users' zone
+REMINDERS_TZ = pytz.timezone(os.environ.get("REMINDERS_TIMEZONE", "Europe/Moscow"))
+TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+PERIOD_RE = re.compile(r"^(\d+)([mh])$")
+
+
+def next_time_of_day(value):
+    match = TIME_RE.match(value)
+    if not match:
+        return None
+    now = datetime.datetime.now(REMINDERS_TZ)
+    at = datetime.time(int(match.group(1)), int(match.group(2)))
+    due = REMINDERS_TZ.localize(datetime.datetime.combine(now.date(), at))
+    if due <= now:
+        tomorrow = now.date() + datetime.timedelta(days=1)
+        due = REMINDERS_TZ.localize(datetime.datetime.combine(tomorrow, at))
+    return due.timestamp()
+
+
+def parse_reminder(args):
+    """Returns (due, repeat, phrase) or None if the arguments are wrong."""
+    if len(args) >= 3 and args[0] == "daily":
+        due, repeat, phrase = next_time_of_day(args[1]), 86400, args[2:]
+    elif len(args) >= 3 and args[0] == "every":
+        match = PERIOD_RE.match(args[1])
+        if not match or int(match.group(1)) == 0:
+            return None
+        repeat = int(match.group(1)) * (60 if match.group(2) == "m" else 3600)
+        due, phrase = time.time() + repeat, args[2:]
+    elif len(args) >= 2:
+        due, repeat, phrase = next_time_of_day(args[0]), 0, args[1:]
+    else:
+        return None
+
+    if due is None:
+        return None
+    return due, repeat, " ".join(phrase)
+
+
+def remind(update, context):
+    if context.user_data.get("selected_yandex_speaker") is None:
+        update.message.reply_text(
+            "Sorry, you have not chosen the station yet. Use /set_speaker to start our work."
+        )
+        return
+
+    parsed = parse_reminder(context.args)
+    if parsed is None:
+        update.message.reply_text(REMIND_USAGE)
+        return
+
+    due, repeat, phrase = parsed
+    try:
+        job = station_client.add_reminder(
+            str(update.effective_user.id), due, repeat, phrase
+        )
+    except ValueError:
+        update.message.reply_text(
+            "You have too many reminders. Delete some with /cancel_reminder."
+        )
+        return
+
+    update.message.reply_text(f"Reminder {job.id} is set: {format_reminder(job)}")
+
+
+def format_reminder(job):
+    when = datetime.datetime.fromtimestamp(job.due, REMINDERS_TZ).strftime(
+        "%d.%m %H:%M"
+    )
+    if job.repeat:
+        when += f", every {datetime.timedelta(seconds=job.repeat)}"
+    return f"{when} - {job.phrase}"
+
+
+def reminders(update, context):
+    jobs = station_client.reminders(str(update.effective_user.id))
+    if not jobs:
+        update.message.reply_text("You have no reminders. Use /remind to add one.")
+        return
+
+    lines = [f"{job.id}: {format_reminder(job)}" for job in jobs]
+    update.message.reply_text("\n".join(lines))
+
+
+def cancel_reminder(update, context):
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        update.message.reply_text("Usage: /cancel_reminder <id from /reminders>")
+        return
+
+    if station_client.cancel_reminder(
+        str(update.effective_user.id), int(context.args[0])
+    ):
+        update.message.reply_text("The reminder is deleted.")
+    else:
+        update.message.reply_text("There is no such reminder.")
+
+
+dispatcher.add_handler(CommandHandler("remind", remind), 1)
+dispatcher.add_handler(CommandHandler("reminders", reminders), 1)
+dispatcher.add_handler(CommandHandler("cancel_reminder", cancel_reminder), 1)
+
+
+def selected_speaker(update, context):
+    if context.user_data.get("yandex_auth_token") is None:
+        update.message.reply_text(
+            "Sorry, you have not authorized yet. Use /start to start our work."
+        )
+        return None
+
+    if context.user_data.get("selected_yandex_speaker") is None:
+        update.message.reply_text(
+            "Sorry, you have not chosen the station yet. Use /set_speaker to start our work."
+        )
+        return None
+
+    return context.user_data["selected_yandex_speaker"]
+
+
+def report_failure(update, context, action):
+    # replies only on errors, success is audible on the station
+    def on_done(future):
+        if future.cancelled() or future.exception() is None:
+            return
+        _LOGGER.warning(f"{action} failed: {future.exception()!r}")
+        context.dispatcher.run_async(
+            update.message.reply_text, f"Sorry, I could not {action} the station."
+        )
+
+    return on_done
+
+
+def parse_volume(args):
+    """(value, relative) from "+2", "-1" or "5", None if invalid."""
+    if len(args) != 1:
+        return None
+    text = args[0]
+    try:
+        value = int(text)
+    except ValueError:
+        return None
+    if text[0] in "+-":
+        return value, True
+    if 0 <= value <= 10:
+        return value, False
+    return None
+
+
+def volume(update, context):
+    speaker = selected_speaker(update, context)
+    if speaker is None:
+        return
+
+    action = parse_volume(context.args)
+    if action is None:
+        update.message.reply_text("Usage: /volume +N, /volume -N or /volume 0..10")
+        return
+
+    future = station_client.device_action(
+        context.user_data["yandex_auth_token"], speaker, {"volume": action}
+    )
+    future.add_done_callback(report_failure(update, context, "change the volume of"))
+
+
+def toggle_command(name, action):
+    def handler(update, context):
+        speaker = selected_speaker(update, context)
+        if speaker is None:
+            return
+
+        value = not (context.args and context.args[0] == "off")
+        future = station_client.device_action(
+            context.user_data["yandex_auth_token"], speaker, {name: (value, False)}
+        )
+        future.add_done_callback(report_failure(update, context, action))
+
+    return handler
+
+
+def dnd(update, context):
+    speaker = selected_speaker(update, context)
+    if speaker is None:
+        return
+
+    if len(context.args) != 1 or context.args[0] not in ("on", "off"):
+        update.message.reply_text("Usage: /dnd on or /dnd off")
+        return
+
+    if speaker.platform is None:
+        update.message.reply_text("Please choose your station again with /set_speaker.")
+        return
+
+    enabled = context.args[0] == "on"
+    future = station_client.update_device_config(
+        context.user_data["yandex_auth_token"],
+        speaker,
+        {"dndMode": {"enabled": enabled}},
+    )
+
+    def on_done(future):
+        if future.cancelled():
+            return
+        if future.exception():
+            _LOGGER.warning(f"DND change failed: {future.exception()!r}")
+            text = "Sorry, I could not change the station settings."
+        elif future.result():
+            text = "Do not disturb is " + ("on." if enabled else "off.")
+        else:
+            text = "Do not disturb is already " + ("on." if enabled else "off.")
+        context.dispatcher.run_async(update.message.reply_text, text)
+
+    future.add_done_callback(on_done)
+
+
+dispatcher.add_handler(CommandHandler("volume", volume), 1)
+dispatcher.add_handler(CommandHandler("pause", toggle_command("pause", "pause")), 1)
+dispatcher.add_handler(CommandHandler("mute", toggle_command("mute", "mute")), 1)
+dispatcher.add_handler(CommandHandler("dnd", dnd), 1)
+
+
+now_playing = NowPlayingNotifier(
+    updater.bot,
+    dispatcher.run_async,
+    min_interval=float(os.environ.get("NOWPLAYING_MIN_INTERVAL", 5)),
+)
+
+
+def nowplaying(update, context):
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0] == "off":
+        station_client.unsubscribe_state(chat_id)
+        if now_playing.unsubscribe(chat_id):
+            update.message.reply_text("Now playing updates are off.")
+        else:
+            update.message.reply_text(
+                "You are not subscribed. Use /nowplaying to start."
+            )
+        return
+
+    if context.user_data.get("selected_yandex_speaker") is None:
+        update.message.reply_text(
+            "Sorry, you have not chosen the station yet. Use /set_speaker to start our work."
+        )
+        return
+
+    message = update.message.reply_text("Connecting to the station...")
+    now_playing.subscribe(chat_id, message.message_id)
+    try:
+        station_client.subscribe_state(
+            context.user_data["yandex_auth_token"],
+            context.user_data["selected_yandex_speaker"],
+            chat_id,
+            lambda data: now_playing.on_state(chat_id, data),
+        )
+    except StationNotReachableException:
+        now_playing.unsubscribe(chat_id)
+        message.edit_text(
+            "Now playing works only when the bot is in the same local network as your station."
+        )
+
+
+dispatcher.add_handler(CommandHandler("nowplaying", nowplaying), 1)
+
+
+def resolve_user(user):
+    # called from the asyncio thread, the user may have changed the station
+    user_data = dispatcher.user_data.get(int(user), {})
+    token = user_data.get("yandex_auth_token")
+    speaker = user_data.get("selected_yandex_speaker")
+    if token is None or speaker is None:
+        return None
+    return token, speaker
+
+
 def delete_users_station_info(update, context):
     context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -314,7 +883,18 @@ def delete_users_station_info(update, context):
         "If you want to restart your work, use /start.",
     )
 
-    lst = ["yandex_auth_token", "selected_yandex_speaker"]
+    token = context.user_data.get("yandex_auth_token")
+    if token:
+        station_client.forget(token)
+
+    station_client.unsubscribe_state(update.effective_chat.id)
+    now_playing.unsubscribe(update.effective_chat.id)
+
+    user = str(update.effective_user.id)
+    for job in station_client.reminders(user):
+        station_client.cancel_reminder(user, job.id)
+
+    lst = ["yandex_auth_token", "selected_yandex_speaker", "broadcast_speakers"]
     for key in lst:
         context.user_data.pop(key, None)
 
@@ -353,6 +933,64 @@ inline_caps_handler = InlineQueryHandler(inline_caps)
 dispatcher.add_handler(inline_caps_handler, 1)
 
 
+profiler = UpdateProfiler(slowest=int(os.environ.get("PROFILER_SLOWEST", 10)))
+
+
+def is_admin(update):
+    return str(update.effective_user.id) in admins
+
+
+def profile(update, context):
+    if not is_admin(update):
+        unknown(update, context)
+        return
+
+    action = context.args[0] if context.args else "stats"
+    if action == "on":
+        profiler.start_sampling()
+        text = "Sampling profiler is on."
+    elif action == "off":
+        profiler.stop_sampling()
+        text = "Sampling profiler is off."
+    elif action == "dump":
+        paths = profiler.dump()
+        lines = [record.summary() for record in profiler.slowest_updates()]
+        text = "\n".join(lines + paths) or "No profiled updates yet."
+    else:
+        lines = profiler.top_handlers()
+        text = f"Updates: {profiler.updates}\n" + "\n".join(lines)
+
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+
+profile_handler = CommandHandler("profile", profile)
+dispatcher.add_handler(profile_handler, 1)
+
+
+def stats(update, context):
+    if not is_admin(update):
+        unknown(update, context)
+        return
+
+    lines = []
+    metrics = dict(
+        station_client.stats(),
+        startup=startup_metrics,
+        dedup=dedup.stats(),
+        nowplaying=now_playing.stats(),
+    )
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            lines += [f"{name}.{k}: {v:.4g}" for k, v in value.items()]
+        else:
+            lines.append(f"{name}: {value}")
+    context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(lines))
+
+
+stats_handler = CommandHandler("stats", stats)
+dispatcher.add_handler(stats_handler, 1)
+
+
 def unknown(update, context):
     context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -363,10 +1001,35 @@ def unknown(update, context):
 unknown_handler = MessageHandler(Filters.command, unknown)
 dispatcher.add_handler(unknown_handler, 1)
 
-station_client = SyncCloudClient()
-updater.start_polling()
-try:
-    station_client.start()
-except KeyboardInterrupt:
-    print("Received exit, exiting")
-updater.stop()
+profiler.install(dispatcher)
+
+if __name__ == "__main__":
+    station_client = SyncCloudClient(
+        scenarios=dispatcher.bot_data.setdefault("scenario_registry", {}),
+        outbox=Outbox(
+            os.environ.get("OUTBOX_PATH", os.path.join(DATA_DIR, "outbox.sqlite3"))
+        ),
+        session_store=dispatcher.bot_data.setdefault("yandex_sessions", {}),
+        jobs=JobStore(
+            os.environ.get(
+                "REMINDERS_PATH", os.path.join(DATA_DIR, "reminders.sqlite3")
+            )
+        ),
+        resolve_user=resolve_user,
+        store_lock=my_persistence.lock,
+    )
+    updater.start_polling()
+    # the round-trip to Telegram does not delay polling
+    dispatcher.run_async(sync_commands)
+    startup_metrics["polling_s"] = time.monotonic() - STARTED_AT
+    _LOGGER.info(f"Polling started in {startup_metrics['polling_s']:.2f}s")
+    try:
+        station_client.start(before_stop=updater.stop)
+    except KeyboardInterrupt:
+        print("Received exit, exiting")
+    updater.stop()
+    # sessions and scenarios saved after the last update are not written yet
+    dispatcher.update_persistence()
+    my_persistence.flush()
+    dedup.flush()
+    tracing.shutdown()
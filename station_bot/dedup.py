@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Set
+
+from telegram import Update
+from telegram.ext import DispatcherHandlerStop, TypeHandler
+
+_LOGGER = logging.getLogger(__name__)
+
+# before the startup metric, the profiler and access_check
+DEDUP_GROUP = -20
+
+
+class UpdateDeduplicator:
+    """Drops updates whose update_id was already dispatched.
+
+    The last `window` ids are kept in a set, so a redelivered update is
+    found in O(1). Older ids, and everything up to the mark saved by the
+    previous run, are dropped by one comparison. The saved mark only covers
+    updates whose dispatch has finished, so an update interrupted by a crash
+    is handled again. It is kept per bot id, written atomically and at most
+    once per `flush_interval` seconds.
+
+    Telegram starts a new random sequence after a week without updates. An
+    id more than `window` below the highest one seen is taken for such a
+    reset and starts a new window instead of being dropped.
+    """
+
+    def __init__(
+        self,
+        path: str = "update_hwm.json",
+        bot_id: int = 0,
+        window: int = 10000,
+        flush_interval: float = 5.0,
+    ):
+        self.path = path
+        self.bot_id = str(bot_id)
+        self.window = window
+        self.flush_interval = flush_interval
+
+        self.order: Deque[int] = deque()
+        self.seen: Set[int] = set()
+        # accepted ids whose dispatch has not finished yet
+        self.in_flight: Set[int] = set()
+        # marks of other bots sharing the file
+        self.marks: Dict[str, int] = self._load()
+        # ids up to floor are either evicted from the window or were
+        # dispatched before the restart
+        self.floor = self.marks.get(self.bot_id, 0)
+        self.hwm = self.floor
+        self.saved_mark = self.floor
+        self.saved_at = 0.0
+        self.duplicates = 0
+        self.resets = 0
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, int]:
+        try:
+            with open(self.path) as f:
+                return {k: int(v) for k, v in json.load(f)["bots"].items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            _LOGGER.warning(f"Ignoring broken {self.path}: {e!r}")
+            return {}
+
+    def install(self, dispatcher):
+        dispatcher.add_handler(TypeHandler(Update, self.check), DEDUP_GROUP)
+
+        process_update = dispatcher.process_update
+
+        def process(update):
+            try:
+                return process_update(update)
+            finally:
+                if isinstance(update, Update):
+                    self.done(update.update_id)
+
+        dispatcher.process_update = process
+
+    def check(self, update: Update, context):
+        if not self.accept(update.update_id):
+            _LOGGER.info(f"Dropping duplicate update {update.update_id}")
+            raise DispatcherHandlerStop
+
+    def accept(self, update_id: int) -> bool:
+        """Remembers update_id, False if it was already seen."""
+        with self._lock:
+            if update_id < self.hwm - self.window:
+                _LOGGER.warning(
+                    f"update_id went back from {self.hwm} to {update_id}, "
+                    "starting a new sequence"
+                )
+                self._reset(update_id)
+
+            if update_id <= self.floor or update_id in self.seen:
+                self.duplicates += 1
+                return False
+
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            self.in_flight.add(update_id)
+            if len(self.order) > self.window:
+                evicted = self.order.popleft()
+                self.seen.discard(evicted)
+                self.floor = max(self.floor, evicted)
+
+            self.hwm = max(self.hwm, update_id)
+        return True
+
+    def done(self, update_id: int):
+        """Marks the dispatch of update_id as finished."""
+        with self._lock:
+            self.in_flight.discard(update_id)
+            if time.monotonic() - self.saved_at >= self.flush_interval:
+                self._save()
+
+    def _reset(self, update_id: int):
+        self.resets += 1
+        self.order.clear()
+        self.seen.clear()
+        self.in_flight.clear()
+        self.floor = self.hwm = update_id - 1
+
+    def flush(self):
+        with self._lock:
+            self._save()
+
+    def _mark(self) -> int:
+        # everything below the oldest unfinished update is done
+        if self.in_flight:
+            return min(self.in_flight) - 1
+        return self.hwm
+
+    def _save(self):
+        self.saved_at = time.monotonic()
+        mark = self._mark()
+        if mark == self.saved_mark:
+            return
+
+        self.marks[self.bot_id] = mark
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"bots": self.marks}, f)
+            os.replace(tmp, self.path)
+            self.saved_mark = mark
+        except OSError as e:
+            _LOGGER.warning(f"Cannot save {self.path}: {e!r}")
+
+    def stats(self) -> dict:
+        return {
+            "window": len(self.order),
+            "hwm": self.hwm,
+            "in_flight": len(self.in_flight),
+            "duplicates": self.duplicates,
+            "resets": self.resets,
+        }
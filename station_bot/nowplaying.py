@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def render(data: Optional[dict]) -> Optional[str]:
+    """Text of the now-playing message, None if the frame has no state."""
+    if data is None:
+        return "The station is offline."
+
+    state = data.get("state")
+    if state is None:
+        return None
+
+    player = state.get("playerState") or {}
+    title = player.get("title")
+    if not title:
+        return "Nothing is playing."
+
+    if player.get("subtitle"):
+        title = f"{title} — {player['subtitle']}"
+    return ("▶️ " if state.get("playing") else "⏸ ") + title
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token, possibly one that is not there yet, and returns
+        how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Subscription:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.text: Optional[str] = None
+        self.pending: Optional[str] = None
+        self.scheduled = False
+        self.reserved = False
+        self.next_edit = 0.0
+
+
+class NowPlayingNotifier:
+    """Keeps one message per subscribed chat and edits it when the station
+    state changes.
+
+    The station sends its state every second or so. Frames that render to
+    the text already shown cost a comparison. A change is edited at most
+    once per `min_interval` seconds per chat, and intermediate changes
+    collapse into the latest one. All chats together are edited at most
+    `max_rate` times per second, so many subscribers playing at once stay
+    under the bot-wide flood limit. State arrives on the asyncio thread,
+    the edits themselves go through `run_async` to the dispatcher workers.
+    """
+
+    def __init__(
+        self,
+        bot,
+        run_async: Callable,
+        min_interval: float = 5.0,
+        max_rate: float = 25.0,
+    ):
+        self.bot = bot
+        self.run_async = run_async
+        self.min_interval = min_interval
+        self.bucket = TokenBucket(max_rate)
+
+        self.subscriptions: Dict[int, Subscription] = {}
+        self.edits = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, chat_id: int, message_id: int):
+        with self._lock:
+            self.subscriptions[chat_id] = Subscription(message_id)
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        with self._lock:
+            return self.subscriptions.pop(chat_id, None) is not None
+
+    def on_state(self, chat_id: int, data: Optional[dict]):
+        text = render(data)
+        if text is None:
+            return
+
+        with self._lock:
+            sub = self.subscriptions.get(chat_id)
+            if sub is None:
+                return
+            if text == (sub.pending or sub.text):
+                self.skipped += 1
+                return
+            if sub.pending is not None:
+                self.coalesced += 1
+            sub.pending = text
+            if sub.scheduled:
+                return
+            sub.scheduled = True
+            delay = max(0.0, sub.next_edit - time.monotonic())
+
+        asyncio.get_event_loop().call_later(delay, self._flush, chat_id)
+
+    def _flush(self, chat_id: int):
+        with self._lock:
+            sub = self.subscriptions.get(chat_id)
+            if sub is None:
+                return
+            if sub.pending is None or sub.pending == sub.text:
+                sub.scheduled = sub.reserved = False
+                sub.pending = None
+                return
+            wait = 0.0 if sub.reserved else self.bucket.reserve()
+            if wait:
+                # stays scheduled, later frames keep collapsing into it
+                sub.reserved = True
+                self.throttled += 1
+            else:
+                sub.scheduled = sub.reserved = False
+                text, sub.pending = sub.pending, None
+                sub.text = text
+                sub.next_edit = time.monotonic() + self.min_interval
+                message_id = sub.message_id
+
+        if wait:
+            asyncio.get_event_loop().call_later(wait, self._flush, chat_id)
+        else:
+            self.run_async(self._edit, chat_id, message_id, text)
+
+    def _edit(self, chat_id: int, message_id: int, text: str):
+        try:
+            self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            with self._lock:
+                self.edits += 1
+        except RetryAfter as e:
+            with self._lock:
+                sub = self.subscriptions.get(chat_id)
+                if sub:
+                    # shown text is unknown now, the next frame retries
+                    sub.text = None
+                    sub.next_edit = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            if "not modified" in e.message:
+                return
+            # the message was deleted, stop editing it
+            _LOGGER.info(f"Now playing in {chat_id} stopped: {e.message}")
+            self.unsubscribe(chat_id)
+        except TelegramError as e:
+            _LOGGER.warning(f"Now playing edit failed: {e!r}")
+
+    def stats(self) -> dict:
+        return {
+            "subscriptions": len(self.subscriptions),
+            "edits": self.edits,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,21 @@
+import threading
+
+from telegram.ext import PicklePersistence
+
+
+class LockedPicklePersistence(PicklePersistence):
+    """PicklePersistence that copies bot_data under `lock`.
+
+    The dispatcher copies the data after every update, while the station
+    client changes its bot_data sub-dicts from the asyncio thread. Writers
+    from other threads hold the same lock.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+
+    def replace_bot(self, obj):
+        # every update_* passes the live data through here first
+        with self.lock:
+            return super().replace_bot(obj)
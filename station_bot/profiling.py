@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import ConversationHandler, DispatcherHandlerStop, TypeHandler
+
+_LOGGER = logging.getLogger(__name__)
+
+PROFILER_ENTER_GROUP = -1
+PROFILER_EXIT_GROUP = 100
+
+
+class UpdateRecord:
+    def __init__(self, update_id: int, thread_id: int):
+        self.update_id = update_id
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.handlers: List[tuple] = []
+        self.samples: Counter = Counter()
+
+    def summary(self) -> str:
+        handlers = ", ".join(f"{name} {dt * 1000:.1f}ms" for name, dt in self.handlers)
+        return f"update {self.update_id}: {self.duration * 1000:.1f}ms ({handlers})"
+
+
+def iter_handlers(handler):
+    yield handler
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for handlers in handler.states.values():
+            nested += handlers
+        for h in nested:
+            yield from iter_handlers(h)
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class UpdateProfiler:
+    """Times every update from entry to exit and records the handlers that
+    consumed it. When sampling is enabled, a background thread samples the
+    dispatcher thread's stack and keeps folded stacks of the slowest updates.
+    """
+
+    def __init__(
+        self, slowest: int = 10, interval: float = 0.005, output_dir: str = "profiles"
+    ):
+        self.slowest = slowest
+        self.interval = interval
+        self.output_dir = output_dir
+
+        self.handler_stats: Dict[str, List[float]] = {}
+        self.updates = 0
+
+        self._current: Optional[UpdateRecord] = None
+        self._lock = threading.Lock()
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._sampler: Optional[threading.Thread] = None
+        self._sampling = threading.Event()
+
+    @property
+    def sampling(self) -> bool:
+        return self._sampling.is_set()
+
+    def install(self, dispatcher):
+        """Wraps every registered handler and adds the entry/exit hooks.
+        Call it after all handlers are added to the dispatcher.
+        """
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                for h in iter_handlers(handler):
+                    self._wrap(h)
+
+        dispatcher.add_handler(TypeHandler(object, self.on_enter), PROFILER_ENTER_GROUP)
+        dispatcher.add_handler(TypeHandler(object, self.on_exit), PROFILER_EXIT_GROUP)
+
+    def _wrap(self, handler):
+        callback = getattr(handler, "callback", None)
+        if callback is None or getattr(callback, "_profiled", False):
+            return
+
+        name = getattr(callback, "__name__", repr(callback))
+
+        def profiled(update, context):
+            ts = time.perf_counter()
+            try:
+                return callback(update, context)
+            except DispatcherHandlerStop:
+                self._record_handler(name, time.perf_counter() - ts)
+                self._finish()
+                raise
+            finally:
+                if self._current is not None:
+                    self._record_handler(name, time.perf_counter() - ts)
+
+        profiled._profiled = True
+        profiled.__name__ = name
+        handler.callback = profiled
+
+    def _record_handler(self, name: str, duration: float):
+        record = self._current
+        if record is None:
+            return
+        record.handlers.append((name, duration))
+
+        stats = self.handler_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+    def on_enter(self, update, context):
+        update_id = update.update_id if isinstance(update, Update) else 0
+        self._current = UpdateRecord(update_id, threading.get_ident())
+
+    def on_exit(self, update, context):
+        self._finish()
+
+    def _finish(self):
+        record = self._current
+        if record is None:
+            return
+        self._current = None
+
+        record.duration = time.perf_counter() - record.started
+        self.updates += 1
+        _LOGGER.debug(record.summary())
+
+        if not self.sampling:
+            return
+
+        with self._lock:
+            item = (record.duration, next(self._seq), record)
+            if len(self._heap) < self.slowest:
+                heapq.heappush(self._heap, item)
+            elif item[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def start_sampling(self):
+        if self.sampling:
+            return
+        with self._lock:
+            self._heap.clear()
+        self._sampling.set()
+        self._sampler = threading.Thread(
+            target=self._sample_loop, name="update-profiler", daemon=True
+        )
+        self._sampler.start()
+
+    def stop_sampling(self):
+        self._sampling.clear()
+
+    def _sample_loop(self):
+        while self._sampling.is_set():
+            record = self._current
+            if record is not None:
+                frame = sys._current_frames().get(record.thread_id)
+                if frame is not None:
+                    stack = []
+                    while frame is not None:
+                        stack.append(format_frame(frame))
+                        frame = frame.f_back
+                    record.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def slowest_updates(self) -> List[UpdateRecord]:
+        with self._lock:
+            return [item[2] for item in sorted(self._heap, reverse=True)]
+
+    def dump(self) -> List[str]:
+        """Writes folded stacks (flamegraph.pl / speedscope format) of the
+        slowest updates and returns the file paths.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for record in self.slowest_updates():
+            path = os.path.join(
+                self.output_dir,
+                f"update-{record.update_id}-{int(record.duration * 1000)}ms.folded",
+            )
+            with open(path, "w") as f:
+                for stack, count in record.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+        return paths
+
+    def top_handlers(self, limit: int = 10) -> List[str]:
+        items = sorted(
+            self.handler_stats.items(), key=lambda kv: kv[1][1], reverse=True
+        )
+        return [
+            f"{name}: {count} calls, avg {total / count * 1000:.1f}ms, "
+            f"max {max_ * 1000:.1f}ms"
+            for name, (count, total, max_) in items[:limit]
+        ]
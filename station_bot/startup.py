@@ -0,0 +1,7 @@
+"""Process start time. main.py imports this module before everything else,
+so the startup metrics include the time spent on the other imports.
+"""
+
+import time
+
+STARTED_AT = time.monotonic()
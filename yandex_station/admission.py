@@ -0,0 +1,54 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Hashable
+
+
+class AdmissionController:
+    """Ограничивает число принятых, но ещё не выполненных запросов на
+    пользователя и в целом. Лишние запросы отклоняются сразу, а не копятся
+    в очереди. Потокобезопасен: принимает поток бота, освобождает цикл
+    asyncio.
+    """
+
+    def __init__(self, per_user: int, total: int):
+        self.per_user = per_user
+        self.total = total
+
+        self.pending: Dict[Hashable, int] = defaultdict(int)
+        self.pending_total = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, user: Hashable) -> bool:
+        with self._lock:
+            if (self.pending[user] >= self.per_user or
+                    self.pending_total >= self.total):
+                self.rejected += 1
+                return False
+
+            self.pending[user] += 1
+            self.pending_total += 1
+            self.accepted += 1
+            return True
+
+    def release(self, user: Hashable) -> int:
+        """Возвращает, сколько запросов пользователя ещё ждут."""
+        with self._lock:
+            self.pending_total -= 1
+            left = self.pending[user] - 1
+            if left > 0:
+                self.pending[user] = left
+            else:
+                self.pending.pop(user, None)
+            return max(left, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'pending': self.pending_total,
+                'pending_users': len(self.pending),
+                'pending_max_per_user': max(self.pending.values(), default=0),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+            }
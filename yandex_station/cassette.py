@@ -0,0 +1,264 @@
+"""Запись и воспроизведение HTTP-обмена для YandexSession.
+
+RecordingSession оборачивает настоящую ClientSession и пишет пары
+запрос-ответ в кассету (JSONL, сжатый gzip). Токены, пароли, cookies и всё,
+что ловит utils.RE_PRIVATE, заменяются заглушками той же длины и из тех же
+символов, поэтому регулярки вроде RE_CSRF на записи продолжают работать.
+
+ReplaySession отдаёт записанные ответы без сети с исходными или
+масштабированными задержками:
+
+    session = ReplaySession('login.jsonl.gz', speed=0)
+    yandex = YandexSession(session, x_token='x')
+"""
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import re
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, CookieJar
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from .utils import RE_PRIVATE
+
+_LOGGER = logging.getLogger(__name__)
+
+# значения с такими ключами в JSON, формах и query не сохраняются
+RE_SECRET_KEY = re.compile(
+    r'token|password|secret|session|track_id|login|cookie|csrf|^uid$|'
+    r'captcha', re.IGNORECASE)
+RE_SECRET_JSON = re.compile(
+    r'"([A-Za-z0-9_]*(?:[Tt]oken|[Pp]assword|[Ss]ecret|[Ss]ession|track_id|'
+    r'login|[Cc]ookie|csrf|captcha)[A-Za-z0-9_]*|uid)"(\s*:\s*)"((?:\\.|[^"\\])*)"')
+# из заголовков ответа оставляем только влияющие на разбор тела
+KEEP_HEADERS = ('Content-Type', 'Content-Encoding', 'Location')
+
+
+def mask(value: str) -> str:
+    """Заглушка той же длины: буквы -> x/X, цифры -> 0."""
+    return re.sub(r'[a-z]', 'x', re.sub(r'[A-Z]', 'X', re.sub(
+        r'[0-9]', '0', value)))
+
+
+def scrub_text(text: str) -> str:
+    text = RE_SECRET_JSON.sub(lambda m: f'"{m[1]}"{m[2]}"{mask(m[3])}"', text)
+    return RE_PRIVATE.sub(lambda m: mask(m[0]), text)
+
+
+def scrub_url(url: URL) -> str:
+    query = [
+        (k, mask(v) if RE_SECRET_KEY.search(k) else v)
+        for k, v in url.query.items()
+    ]
+    return scrub_text(str(url.with_query(query)))
+
+
+def request_url(url, params=None) -> URL:
+    url = URL(url)
+    if params:
+        url = url.update_query(params)
+    return url
+
+
+class CassetteResponse:
+    """Ответ из кассеты с тем же интерфейсом, что нужен YandexSession и
+    search_stream от aiohttp.ClientResponse.
+    """
+
+    def __init__(self, method: str, url: str, status: int, headers: dict,
+                 body: bytes):
+        self.method = method.upper()
+        self.url = URL(url)
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self._body = body
+        self.content = _Content(body)
+        self.closed = False
+
+    @property
+    def charset(self) -> Optional[str]:
+        m = re.search(r'charset=([\w-]+)', self.headers.get('Content-Type', ''))
+        return m[1] if m else None
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = None) -> str:
+        return self._body.decode(encoding or self.charset or 'utf-8')
+
+    async def json(self, **kwargs):
+        return json.loads(await self.text())
+
+    def close(self):
+        self.closed = True
+
+    def release(self):
+        pass
+
+    def raise_for_status(self):
+        assert self.status < 400, f"{self.url} return {self.status} status"
+
+
+class _Content:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def iter_chunked(self, n: int):
+        for i in range(0, len(self._body), n):
+            yield self._body[i:i + n]
+
+    async def read(self, n: int = -1) -> bytes:
+        data, self._body = (self._body, b'') if n < 0 else \
+            (self._body[:n], self._body[n:])
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        if len(self._body) < n:
+            raise asyncio.IncompleteReadError(self._body, n)
+        return await self.read(n)
+
+
+def encode_entry(method: str, url: str, status: int, headers: dict,
+                 body: bytes, elapsed: float) -> dict:
+    entry = {
+        'method': method.upper(), 'url': url, 'status': status,
+        'headers': headers, 'elapsed': round(elapsed, 4),
+    }
+    try:
+        entry['body'] = scrub_text(body.decode('utf-8'))
+    except UnicodeDecodeError:
+        entry['body_b64'] = base64.b64encode(body).decode()
+    return entry
+
+
+def decode_body(entry: dict) -> bytes:
+    if 'body_b64' in entry:
+        return base64.b64decode(entry['body_b64'])
+    return entry['body'].encode('utf-8')
+
+
+class RecordingSession:
+    """Пропускает запросы в настоящую сессию и пишет их в кассету."""
+
+    def __init__(self, session: ClientSession, path: str):
+        self.session = session
+        self.path = path
+        self.entries: List[dict] = []
+
+    @property
+    def cookie_jar(self):
+        return self.session.cookie_jar
+
+    async def _request(self, method: str, url, **kwargs):
+        ts = time.monotonic()
+        r = await self.session.request(method, url, **kwargs)
+        body = await r.read()
+        elapsed = time.monotonic() - ts
+
+        headers = {k: r.headers[k] for k in KEEP_HEADERS if k in r.headers}
+        cookies = [
+            f"{name}={mask(morsel.value)}" for name, morsel in r.cookies.items()
+        ]
+        if cookies:
+            headers['Set-Cookie'] = cookies
+
+        url = scrub_url(request_url(url, kwargs.get('params')))
+        self.entries.append(encode_entry(method, url, r.status, headers,
+                                         body, elapsed))
+        return CassetteResponse(method, str(r.url), r.status,
+                                dict(r.headers), body)
+
+    async def get(self, url, **kwargs):
+        return await self._request('get', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request('post', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self._request('put', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self._request('delete', url, **kwargs)
+
+    async def ws_connect(self, *args, **kwargs):
+        # локальный протокол не записываем
+        return await self.session.ws_connect(*args, **kwargs)
+
+    def save(self):
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        _LOGGER.debug(f"Записано {len(self.entries)} запросов в {self.path}")
+
+    async def close(self):
+        self.save()
+        await self.session.close()
+
+
+class CassetteMissError(LookupError):
+    """Запроса нет в кассете. Вебсокеты Glagol не записываются вовсе."""
+
+
+class ReplaySession:
+    """Отдаёт ответы из кассеты по методу и адресу (с замаскированными
+    параметрами) в порядке записи, по кругу. На запрос, которого нет в
+    кассете, и на ws_connect бросает CassetteMissError.
+
+    :param speed: множитель записанных задержек, 0 - без задержек
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self.cookie_jar = CookieJar()
+        self.served = 0
+
+        self.entries: Dict[Tuple[str, str], Deque[dict]] = defaultdict(deque)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries[entry['method'], entry['url']].append(entry)
+
+    async def _request(self, method: str, url, **kwargs):
+        key = method.upper(), scrub_url(request_url(url, kwargs.get('params')))
+        queue = self.entries.get(key)
+        if not queue:
+            raise CassetteMissError(f"{key[0]} {key[1]} is not in {self.path}")
+
+        entry = queue[0]
+        queue.rotate(-1)
+        if self.speed:
+            await asyncio.sleep(entry['elapsed'] * self.speed)
+
+        headers = dict(entry['headers'])
+        for cookie in headers.pop('Set-Cookie', []):
+            name, value = cookie.split('=', 1)
+            self.cookie_jar.update_cookies({name: value}, URL(key[1]))
+
+        self.served += 1
+        return CassetteResponse(method, key[1], entry['status'], headers,
+                                decode_body(entry))
+
+    async def get(self, url, **kwargs):
+        return await self._request('get', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self._request('post', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self._request('put', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self._request('delete', url, **kwargs)
+
+    async def ws_connect(self, url, *args, **kwargs):
+        raise CassetteMissError(f"WS {url}: Glagol is not recorded")
+
+    async def close(self):
+        pass
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+# столько ждём следующих нажатий, прежде чем отправить запрос
+COALESCE_DELAY = 0.3
+
+# действие устройства: имя -> (значение, относительное ли)
+Actions = Dict[str, Tuple[Any, bool]]
+# допустимые абсолютные значения
+ACTION_LIMITS = {'volume': (0, 10)}
+
+
+def merge_actions(pending: Actions, new: Actions) -> Actions:
+    """Итоговое состояние после двух пачек действий: относительные
+    изменения складываются, абсолютные перекрывают предыдущие.
+    """
+    merged = dict(pending)
+    for name, (value, relative) in new.items():
+        if relative and name in merged:
+            old, relative = merged[name]
+            value += old
+        if not relative and name in ACTION_LIMITS:
+            low, high = ACTION_LIMITS[name]
+            value = min(max(value, low), high)
+        merged[name] = (value, relative)
+    return merged
+
+
+def merge_config(pending: dict, new: dict) -> dict:
+    """Рекурсивно накладывает new на pending."""
+    merged = dict(pending)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class _Pending:
+    def __init__(self, change):
+        self.change = change
+        self.future = asyncio.get_event_loop().create_future()
+        self.count = 1
+
+
+class Coalescer:
+    """Склеивает частые изменения одного устройства в один запрос.
+
+    Первое изменение открывает окно delay, все изменения в этом окне
+    сливаются через merge, и apply вызывается один раз с итогом. Все
+    вызвавшие получают его результат. Запросы одного ключа идут строго
+    друг за другом: пока один выполняется, копится следующий.
+    """
+
+    def __init__(self, delay: float = COALESCE_DELAY):
+        self.delay = delay
+        self.pending: Dict[Hashable, _Pending] = {}
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        self.submitted = 0
+        self.applied = 0
+
+    async def submit(self, key: Hashable, change,
+                     merge: Callable[[Any, Any], Any],
+                     apply: Callable[[Any], Awaitable]):
+        self.submitted += 1
+        pending = self.pending.get(key)
+        if pending:
+            pending.change = merge(pending.change, change)
+            pending.count += 1
+        else:
+            pending = self.pending[key] = _Pending(change)
+            asyncio.ensure_future(self.__flush(key, pending, apply))
+
+        return await asyncio.shield(pending.future)
+
+    async def __flush(self, key: Hashable, pending: _Pending,
+                      apply: Callable[[Any], Awaitable]):
+        await asyncio.sleep(self.delay)
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # новые изменения пойдут уже в следующий запрос
+            if self.pending.get(key) is pending:
+                del self.pending[key]
+
+            _LOGGER.debug(f"{key}: {pending.count} изменений одним запросом")
+            self.applied += 1
+            try:
+                pending.future.set_result(await apply(pending.change))
+            except Exception as e:
+                pending.future.set_exception(e)
+
+        if key not in self.pending and not lock.locked():
+            self.locks.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'submitted': self.submitted, 'applied': self.applied}
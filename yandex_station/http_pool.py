@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+
+from aiohttp import ClientSession, CookieJar, TCPConnector, TraceConfig
+
+_LOGGER = logging.getLogger(__name__)
+
+# одновременных соединений на хост, остальные запросы ждут в очереди
+HOST_LIMITS = {
+    'mobileproxy.passport.yandex.net': 5,
+    'oauth.mobile.yandex.net': 5,
+    'iot.quasar.yandex.ru': 20,
+    'quasar.yandex.ru': 10,
+    'quasar.yandex.net': 10,
+    'yandex.ru': 5,
+}
+DEFAULT_HOST_LIMIT = 10
+TOTAL_LIMIT = 100
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+
+
+class PoolStats:
+    """Статистика пула: ожидание соединения и доля переиспользованных."""
+
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        self.trace_config = TraceConfig()
+        self.trace_config.on_connection_queued_start.append(self._queued_start)
+        self.trace_config.on_connection_queued_end.append(self._queued_end)
+        self.trace_config.on_connection_create_end.append(self._created)
+        self.trace_config.on_connection_reuseconn.append(self._reused)
+
+    def add_wait(self, seconds: float):
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    async def _queued_start(self, session, ctx, params):
+        ctx.queued_ts = time.monotonic()
+
+    async def _queued_end(self, session, ctx, params):
+        self.add_wait(time.monotonic() - ctx.queued_ts)
+
+    async def _created(self, session, ctx, params):
+        self.created += 1
+
+    async def _reused(self, session, ctx, params):
+        self.reused += 1
+
+    def snapshot(self) -> dict:
+        acquired = self.created + self.reused
+        return {
+            'connections_created': self.created,
+            'connections_reused': self.reused,
+            'reuse_ratio': self.reused / acquired if acquired else 0,
+            'acquire_waits': self.waits,
+            'acquire_wait_avg': self.wait_total / self.waits if self.waits else 0,
+            'acquire_wait_max': self.wait_max,
+        }
+
+
+class PooledConnector(TCPConnector):
+    """TCPConnector с отдельным лимитом соединений на каждый хост."""
+
+    def __init__(self, stats: PoolStats, host_limits: Dict[str, int] = None,
+                 default_host_limit: int = DEFAULT_HOST_LIMIT, **kwargs):
+        kwargs.setdefault('limit', TOTAL_LIMIT)
+        kwargs.setdefault('keepalive_timeout', KEEPALIVE_TIMEOUT)
+        kwargs.setdefault('ttl_dns_cache', DNS_CACHE_TTL)
+        kwargs.setdefault('use_dns_cache', True)
+        # лимит на хост считаем сами, у aiohttp он один на всех
+        kwargs['limit_per_host'] = 0
+        super().__init__(**kwargs)
+
+        self.stats = stats
+        self.host_limits = host_limits or HOST_LIMITS
+        self.default_host_limit = default_host_limit
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        sem = self._host_semaphores.get(host)
+        if sem is None:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            sem = self._host_semaphores[host] = asyncio.Semaphore(limit)
+        return sem
+
+    async def connect(self, req, traces, timeout):
+        sem = self._host_semaphore(req.host)
+        if sem.locked():
+            ts = time.monotonic()
+            await sem.acquire()
+            self.stats.add_wait(time.monotonic() - ts)
+        else:
+            await sem.acquire()
+
+        try:
+            return await super().connect(req, traces, timeout)
+        except BaseException:
+            sem.release()
+            raise
+
+    def _release(self, key, protocol, *, should_close=False):
+        # вызывается ровно один раз на каждое выданное connect соединение
+        super()._release(key, protocol, should_close=should_close)
+        self._host_semaphore(key.host).release()
+
+
+def create_connector(stats: PoolStats, loop=None) -> PooledConnector:
+    return PooledConnector(stats, loop=loop)
+
+
+def create_session(connector: PooledConnector) -> ClientSession:
+    """Сессия со своими cookies поверх общего пула соединений."""
+    return ClientSession(connector=connector, connector_owner=False,
+                         cookie_jar=CookieJar(),
+                         trace_configs=[connector.stats.trace_config])
+
+
+def create_ws_session(loop=None) -> ClientSession:
+    """Сессия для вебсокетов Глагола. Открытый сокет держит соединение всё
+    время жизни, поэтому у них свой коннектор вне лимитов общего пула.
+    """
+    return ClientSession(connector=TCPConnector(limit=0, loop=loop), loop=loop)
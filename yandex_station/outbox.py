@@ -0,0 +1,112 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple
+
+_LOGGER = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+DROPPED = 'dropped'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    speaker TEXT NOT NULL,
+    phrase TEXT NOT NULL,
+    created REAL NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, created);
+"""
+
+
+class OutboxItem(NamedTuple):
+    key: str
+    token: str
+    speaker: dict
+    phrase: str
+    created: float
+    attempts: int
+
+
+class Outbox:
+    """Журнал принятых фраз в SQLite (WAL) для доставки "хотя бы раз".
+
+    Ключ идемпотентности задаёт вызывающий, например update_id из Telegram,
+    поэтому повторно принятая фраза не попадает в журнал второй раз.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def add(self, key: str, token: str, speaker: dict, phrase: str) -> bool:
+        """Записывает фразу. False, если ключ уже был принят."""
+        with self._lock:
+            cur = self._db.execute(
+                'INSERT OR IGNORE INTO outbox '
+                '(key, token, speaker, phrase, created, state) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, token, json.dumps(speaker), phrase, time.time(),
+                 PENDING)
+            )
+            return cur.rowcount == 1
+
+    def done(self, key: str):
+        self._set_state(key, DONE)
+
+    def drop(self, key: str):
+        self._set_state(key, DROPPED)
+
+    def failed(self, key: str):
+        with self._lock:
+            self._db.execute(
+                'UPDATE outbox SET attempts = attempts + 1 WHERE key = ?',
+                (key,))
+
+    def _set_state(self, key: str, state: str):
+        with self._lock:
+            self._db.execute('UPDATE outbox SET state = ? WHERE key = ?',
+                             (state, key))
+
+    def pending(self, max_age: float, max_attempts: int) -> List[OutboxItem]:
+        """Недоставленные фразы по порядку приёма. Слишком старые и
+        исчерпавшие попытки помечаются как сброшенные.
+        """
+        expired = time.time() - max_age
+        with self._lock:
+            self._db.execute(
+                'UPDATE outbox SET state = ? WHERE state = ? AND '
+                '(created < ? OR attempts >= ?)',
+                (DROPPED, PENDING, expired, max_attempts))
+            rows = self._db.execute(
+                'SELECT key, token, speaker, phrase, created, attempts '
+                'FROM outbox WHERE state = ? ORDER BY created',
+                (PENDING,)).fetchall()
+
+        return [
+            OutboxItem(key, token, json.loads(speaker), phrase, created,
+                       attempts)
+            for key, token, speaker, phrase, created, attempts in rows
+        ]
+
+    def vacuum(self, keep: float):
+        """Удаляет завершённые записи старше keep секунд."""
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM outbox WHERE state != ? AND created < ?',
+                (PENDING, time.time() - keep))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,33 @@
+import threading
+from typing import MutableMapping, Optional
+
+
+class ScenarioRegistry:
+    """Локальный реестр device_id -> scenario_id наших сценариев-пустышек.
+
+    Хранилище - любой словарь, например bot_data из PicklePersistence, тогда
+    реестр переживает перезапуск вместе с данными пользователей. Сервер
+    опрашивается только когда сценария нет в реестре или он перестал
+    существовать. Если хранилище копируют из другого потока, изменения
+    делаются под его lock.
+    """
+
+    def __init__(self, storage: MutableMapping[str, str] = None,
+                 lock: threading.RLock = None):
+        self.storage = storage if storage is not None else {}
+        self.lock = lock or threading.RLock()
+
+    def get(self, device_id: str) -> Optional[str]:
+        return self.storage.get(device_id)
+
+    def set(self, device_id: str, scenario_id: str):
+        if self.storage.get(device_id) != scenario_id:
+            with self.lock:
+                self.storage[device_id] = scenario_id
+
+    def discard(self, device_id: str):
+        with self.lock:
+            self.storage.pop(device_id, None)
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self.storage
@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+# напоминание, опоздавшее больше чем на час (бот лежал), уже не говорим
+MAX_LATENESS = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    due REAL NOT NULL,
+    repeat REAL NOT NULL DEFAULT 0,
+    phrase TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user);
+"""
+
+
+class Job(NamedTuple):
+    id: int
+    user: str
+    due: float
+    # период повтора в секундах, 0 - разовое напоминание
+    repeat: float
+    phrase: str
+
+
+class JobStore:
+    """Напоминания в SQLite (WAL), переживают перезапуск бота."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def add(self, user: str, due: float, repeat: float, phrase: str) -> Job:
+        with self._lock:
+            cur = self._db.execute(
+                'INSERT INTO jobs (user, due, repeat, phrase) VALUES (?, ?, ?, ?)',
+                (user, due, repeat, phrase))
+            return Job(cur.lastrowid, user, due, repeat, phrase)
+
+    def remove(self, user: str, job_id: int) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                'DELETE FROM jobs WHERE id = ? AND user = ?', (job_id, user))
+            return cur.rowcount == 1
+
+    def remove_many(self, ids: List[int]):
+        with self._lock:
+            self._db.executemany('DELETE FROM jobs WHERE id = ?',
+                                 [(i,) for i in ids])
+
+    def move_many(self, jobs: List[Job]):
+        """Сохраняет новые сроки повторяющихся напоминаний."""
+        with self._lock:
+            self._db.executemany('UPDATE jobs SET due = ? WHERE id = ?',
+                                 [(job.due, job.id) for job in jobs])
+
+    def user_jobs(self, user: str) -> List[Job]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, user, due, repeat, phrase FROM jobs '
+                'WHERE user = ? ORDER BY due', (user,)).fetchall()
+        return [Job(*row) for row in rows]
+
+    def count(self, user: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM jobs WHERE user = ?', (user,)
+            ).fetchone()[0]
+
+    def all(self) -> List[Job]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, user, due, repeat, phrase FROM jobs').fetchall()
+        return [Job(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Scheduler:
+    """Куча сроков напоминаний поверх JobStore. Спит до ближайшего срока,
+    а все напоминания с одной и той же секундой отдаёт в deliver разом.
+    Доставка идёт отдельной задачей и не держит следующие сроки. Опоздавшие
+    больше чем на max_lateness не доставляются: разовые удаляются, а
+    повторяющиеся ждут следующего срока.
+    """
+
+    def __init__(self, store: JobStore,
+                 deliver: Callable[[List[Job]], Awaitable],
+                 max_lateness: float = MAX_LATENESS):
+        self.store = store
+        self.deliver = deliver
+        self.max_lateness = max_lateness
+
+        self.heap: List[Tuple[float, int]] = []
+        # id -> актуальное напоминание; отменённые удаляются из кучи лениво
+        self.jobs: Dict[int, Job] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def push(self, job: Job):
+        """Добавляет напоминание. Вызывать из цикла asyncio."""
+        if self.jobs.get(job.id) == job:
+            # add_reminder до того, как run() загрузил то же из хранилища
+            return
+        self.jobs[job.id] = job
+        heapq.heappush(self.heap, (job.due, job.id))
+        # будим, только если срок стал ближе
+        if self._wakeup and self.heap[0][1] == job.id:
+            self._wakeup.set()
+
+    def discard(self, job_id: int):
+        self.jobs.pop(job_id, None)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        for job in self.store.all():
+            self.push(job)
+        _LOGGER.debug(f"Загружено напоминаний: {len(self.jobs)}")
+
+        while True:
+            self._drop_cancelled()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self._pop_due()
+            if due:
+                self._fire(due)
+
+    def _drop_cancelled(self):
+        while self.heap:
+            ts, job_id = self.heap[0]
+            job = self.jobs.get(job_id)
+            if job and job.due == ts:
+                return
+            heapq.heappop(self.heap)
+
+    def _pop_due(self) -> List[Job]:
+        # всё, что приходится на ту же секунду, что и первый срок
+        second = math.floor(self.heap[0][0])
+        due = {}
+        while self.heap and math.floor(self.heap[0][0]) <= second:
+            ts, job_id = heapq.heappop(self.heap)
+            job = self.jobs.get(job_id)
+            if job and job.due == ts:
+                due[job_id] = job
+        return list(due.values())
+
+    def _fire(self, due: List[Job]):
+        now = time.time()
+        fresh, late, moved = [], [], []
+        for job in due:
+            if now - job.due > self.max_lateness:
+                late.append(job)
+            else:
+                fresh.append(job)
+
+            if job.repeat:
+                # пропущенные за время простоя повторы не догоняем
+                periods = max(1, math.ceil((now - job.due) / job.repeat))
+                job = job._replace(due=job.due + periods * job.repeat)
+                moved.append(job)
+                self.push(job)
+            else:
+                # из хранилища разовое удаляется после доставки
+                self.jobs.pop(job.id, None)
+
+        if moved:
+            self.store.move_many(moved)
+        if late:
+            _LOGGER.info(f"Пропущено опоздавших напоминаний: {len(late)}")
+            self.store.remove_many([job.id for job in late if not job.repeat])
+        if fresh:
+            task = asyncio.ensure_future(self._deliver(fresh))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, due: List[Job]):
+        try:
+            await self.deliver(due)
+        except Exception as e:
+            _LOGGER.warning(f"Ошибка доставки напоминаний: {e!r}")
+
+        done = [job.id for job in due if not job.repeat]
+        if done:
+            self.store.remove_many(done)
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые вызовы: пока запрос с ключом
+    выполняется, остальные ждут его результат вместо повторного запроса.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def get(self, key: Hashable) -> Optional[asyncio.Future]:
+        """Текущий запрос с этим ключом, если он есть."""
+        return self._calls.get(key)
+
+    def start(self, key: Hashable,
+              fn: Callable[[], Awaitable]) -> asyncio.Future:
+        """Запускает fn или возвращает уже идущий запрос, не дожидаясь его."""
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        return fut
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        # отмена одного ждущего не отменяет запрос для остальных
+        return await asyncio.shield(self.start(key, fn))
+
+    def _done(self, key: Hashable, fut: asyncio.Future):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        # ошибку получат ждущие, а фоновый запрос просто залогируем
+        if not fut.cancelled() and fut.exception():
+            _LOGGER.debug(f"{key} failed: {fut.exception()!r}")
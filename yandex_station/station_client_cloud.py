@@ -1,17 +1,92 @@
-from typing import List, Union
-from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple, Union
+from dataclasses import asdict, dataclass, replace
 import asyncio
+import concurrent.futures
+import hashlib
+import random
+import signal
+import threading
+import time
 from asyncio.events import AbstractEventLoop
 from aiohttp import ClientSession
 import logging
 
 from .yandex_session import LoginResponse, YandexSession
-from .yandex_quasar import YandexQuasar
-from .utils import fix_cloud_text
+from .yandex_quasar import RELATIVE_INSTANCES, YandexQuasar
+from .scenario_registry import ScenarioRegistry
+from .outbox import Outbox
+from .http_pool import PoolStats, create_connector, create_session, create_ws_session
+from .single_flight import SingleFlight
+from .tracing import bind, span
+from .admission import AdmissionController
+from .coalescer import Actions, Coalescer, merge_actions, merge_config
+from .scheduler import Job, JobStore, Scheduler
+from .utils import get_media_payload, match_media, split_cloud_text
+
+if TYPE_CHECKING:
+    # локальный протокол тянет zeroconf, грузим его только когда нужен
+    from .yandex_glagol import YandexGlagol
 
 _LOGGER = logging.getLogger(__name__)
 
-EXCEPTION_100 = Exception("Нельзя произнести более 100 симоволов :(")
+class PhraseTooLongException(Exception):
+    pass
+
+
+# облако принимает команды до 100 символов, длинный текст говорим по
+# частям и между ними ждём, пока колонка договорит предыдущую
+SAY_MAX_CHUNKS = 5
+TTS_CHARS_PER_SECOND = 15
+
+# список колонок свежий 5 минут, дальше отдаём устаревший и обновляем в фоне
+SPEAKERS_TTL = 300
+SPEAKERS_STALE_TTL = 24 * 3600
+
+# опрос онлайн-статуса колонок у пользователей, активных за последний час
+ONLINE_POLL_INTERVAL = 30
+ONLINE_POLL_CONCURRENCY = 5
+ACTIVE_USER_TTL = 3600
+# статус без свежих опросов (пользователь ушёл) уже ничего не говорит
+ONLINE_STATUS_TTL = 2 * ONLINE_POLL_INTERVAL
+
+# недоставленные фразы повторяем после рестарта и дальше раз в минуту,
+# если они не старше 10 минут и попыток было меньше трёх
+OUTBOX_MAX_AGE = 600
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_RETRY_INTERVAL = 60
+OUTBOX_KEEP = 24 * 3600
+# сколько ждём незавершённые запросы при остановке
+DRAIN_TIMEOUT = 10
+
+# сессии активных пользователей обновляем заранее, раз в 40 минут минус
+# случайные до 20%, чтобы не обновлять всех одновременно. Интервал короче
+# ACTIVE_USER_TTL, иначе сессия закроется раньше, чем дойдёт до обновления.
+# Cookies старше суток меняем на новые, пока старые ещё действуют.
+SESSION_REFRESH_INTERVAL = 40 * 60
+SESSION_COOKIES_MAX_AGE = 24 * 3600
+SESSION_REFRESH_JITTER = 0.2
+SESSION_REFRESH_CHECK = 60
+SESSION_REFRESH_CONCURRENCY = 3
+
+# фразы одного пользователя идут по очереди, не больше 5 в ожидании,
+# всего в ожидании не больше 200 и одновременно в облако не больше 20
+SAY_MAX_PENDING_PER_USER = 5
+SAY_MAX_PENDING = 200
+SAY_CONCURRENCY = 20
+
+REMINDERS_PER_USER = 50
+
+GLAGOL_CONNECT_TIMEOUT = 5
+
+# для станций, где раздел конфига ещё ни разу не настраивали
+CONFIG_DEFAULTS = {
+    'dndMode': {'enabled': False, 'starts': '23:00:00+03', 'ends': '08:00:00+03'},
+}
+
+
+def session_key(token: str) -> str:
+    """Ключ сохранённой сессии, чтобы не хранить x-token ещё раз."""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
 
 
 @dataclass
@@ -20,6 +95,10 @@ class SpeakerConfig:
     name: str
     scenario_id: Union[str, None]
     device_id: str
+    # для локального подключения по протоколу Glagol
+    platform: Optional[str] = None
+    host: Optional[str] = None
+    port: Optional[int] = None
 
 class CaptchaRequiredException(Exception):
     def __init__(self, message, captcha_url: str, track_id: str = None):
@@ -34,39 +113,319 @@ class CaptchaNotOpenedException(Exception):
 class WrongPasswordException(Exception):
     pass
 
+class SpeakerOfflineException(Exception):
+    pass
+
+class UserBusyException(Exception):
+    pass
+
+class StationNotReachableException(Exception):
+    pass
+
+class MediaNotSupportedException(StationNotReachableException):
+    pass
+
 
 class SyncCloudClient:
     session: ClientSession 
     yandex: YandexSession
     loop: AbstractEventLoop
     
-    def __init__(self): 
+    def __init__(self, scenarios: dict = None, outbox: Outbox = None,
+                 session_store: dict = None, jobs: JobStore = None,
+                 resolve_user: Callable[[str], Optional[Tuple[str, SpeakerConfig]]] = None,
+                 store_lock: threading.RLock = None):
+        """
+        :param scenarios: optional dict to persist device_id -> scenario_id
+        :param outbox: optional durable journal for phrases passed with a key
+        :param session_store: optional dict to persist cookies and music token
+        :param jobs: optional store of reminders, enables the scheduler
+        :param resolve_user: returns (token, speaker) of a user for reminders
+        :param store_lock: held while scenarios and session_store change, for
+            a persistence that copies them from another thread
+        """
         self.loop = asyncio.get_event_loop()
-        self.session = ClientSession(loop = self.loop)
+        self.pool_stats = PoolStats()
+        self.connector = create_connector(self.pool_stats, loop=self.loop)
+        self.ws_session = create_ws_session(self.loop)
+        self.store_lock = store_lock or threading.RLock()
+        self.scenario_registry = ScenarioRegistry(scenarios, self.store_lock)
+        self.outbox = outbox
+        self.session_store = session_store if session_store is not None else {}
+
+        self.speakers_cache: Dict[str, Tuple[float, List[SpeakerConfig]]] = {}
+        self.speakers_flight = SingleFlight()
+
+        # token -> время последнего обращения
+        self.active_tokens: Dict[str, float] = {}
+        # quasar_info.device_id -> (время опроса, online)
+        self.online: Dict[str, Tuple[float, bool]] = {}
+
+        # token -> залогиненная сессия пользователя со своими cookies
+        self.sessions: Dict[str, YandexSession] = {}
+        # token -> device_id -> локальное подключение к колонке
+        self.glagols: Dict[str, Dict[str, 'YandexGlagol']] = {}
+        # device_id -> подписчик -> callback состояния колонки
+        self.state_listeners: Dict[str, Dict[Hashable, Callable]] = {}
+        # подписчик -> (token, device_id); подписка держит сессию живой
+        self.state_subscribers: Dict[Hashable, Tuple[str, str]] = {}
+
+        self.coalescer = Coalescer()
+        self.login_flight = SingleFlight()
+
+        self.admission = AdmissionController(SAY_MAX_PENDING_PER_USER, SAY_MAX_PENDING)
+        self.user_locks: Dict[str, asyncio.Lock] = {}
+        self.say_semaphore: Optional[asyncio.Semaphore] = None
+        # ключи фраз, которые доставляются прямо сейчас
+        self.delivering: Set[str] = set()
+
+        self.jobs = jobs
+        self.resolve_user = resolve_user
+        self.scheduler = Scheduler(jobs, self.__deliver_reminders) if jobs else None
+        self.session_refresh_at: Dict[str, float] = {}
+
+    def start(self, before_stop: Callable = None):
+        """Runs the loop until SIGINT/SIGTERM. On stop calls before_stop in
+        a thread (e.g. updater.stop), then waits for in-flight requests.
+        """
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.__shutdown, before_stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        background = [
+            self.loop.create_task(self.__poll_online()),
+            self.loop.create_task(self.__refresh_sessions()),
+        ]
+        if self.outbox:
+            background.append(self.loop.create_task(self.__replay_outbox()))
+        if self.scheduler:
+            background.append(self.loop.create_task(self.scheduler.run()))
 
-    def start(self):
         try:
             self.loop.run_forever()
         finally:
-            self.loop.run_until_complete(self.session.close())
+            for task in background:
+                task.cancel()
+
+            # задачи локальных подключений живут, пока открыт websocket,
+            # и ждут переподключения - закрываем и не ждём их
+            self.loop.run_until_complete(self.__stop_glagols())
+            for task in asyncio.all_tasks(self.loop):
+                if self.__is_glagol_task(task):
+                    task.cancel()
+
+            pending = [t for t in asyncio.all_tasks(self.loop) if not t.done()]
+            if pending:
+                _LOGGER.info(f"Ждём завершения {len(pending)} запросов")
+                self.loop.run_until_complete(
+                    asyncio.wait(pending, timeout=DRAIN_TIMEOUT))
+
+            for token in list(self.sessions):
+                self.loop.run_until_complete(self.__close_session(token))
+            self.loop.run_until_complete(self.ws_session.close())
+            if self.outbox:
+                self.outbox.close()
+            if self.jobs:
+                self.jobs.close()
+
+    async def __stop_glagols(self):
+        for glagols in self.glagols.values():
+            for glagol in glagols.values():
+                await glagol.stop()
+        self.glagols.clear()
+
+    @staticmethod
+    def __is_glagol_task(task: asyncio.Task) -> bool:
+        name = getattr(task.get_coro(), '__qualname__', '')
+        return name.startswith('YandexGlagol.')
+
+    def __shutdown(self, before_stop: Callable = None):
+        async def shutdown():
+            if before_stop:
+                await self.loop.run_in_executor(None, before_stop)
+            self.loop.stop()
+
+        self.loop.create_task(shutdown())
+
+    def __touch(self, token: str):
+        self.active_tokens[token] = time.time()
+
+    async def __poll_online(self):
+        semaphore = asyncio.Semaphore(ONLINE_POLL_CONCURRENCY)
+
+        async def update(token: str):
+            async with semaphore:
+                try:
+                    quasar = await self.__get_quasar(token)
+                    online = await quasar.update_online_stats()
+                    now = time.time()
+                    self.online.update({k: (now, v) for k, v in online.items()})
+                except Exception as e:
+                    _LOGGER.debug(f"Ошибка обновления статуса колонок: {e!r}")
+
+        while True:
+            await asyncio.sleep(ONLINE_POLL_INTERVAL)
+            await self.__expire_inactive()
+            await asyncio.gather(*[update(t) for t in list(self.active_tokens)])
+
+    async def __expire_inactive(self):
+        expired = time.time() - ACTIVE_USER_TTL
+        subscribed = {token for token, _ in self.state_subscribers.values()}
+        for token, ts in list(self.active_tokens.items()):
+            if ts < expired and token not in subscribed:
+                self.active_tokens.pop(token, None)
+                await self.__close_session(token)
+
+    def __is_offline(self, device_id: str) -> bool:
+        """Только свежий опрос говорит, что колонка точно не в сети."""
+        status = self.online.get(device_id)
+        return status is not None and not status[1] and \
+            time.time() - status[0] < ONLINE_STATUS_TTL
+
+    async def __refresh_sessions(self):
+        """Заранее обновляет cookies, CSRF и music token активных
+        пользователей, чтобы первое сообщение после истечения не ждало.
+        """
+        semaphore = asyncio.Semaphore(SESSION_REFRESH_CONCURRENCY)
+
+        async def refresh(token: str, yandex: YandexSession):
+            async with semaphore:
+                try:
+                    saved = self.session_store.get(session_key(token)) or {}
+                    if time.time() - saved.get('saved_at', 0) > SESSION_COOKIES_MAX_AGE:
+                        await yandex.rotate_cookies()
+                        if yandex.music_token:
+                            await yandex.refresh_music_token()
+                    await yandex.refresh_csrf_token()
+                    self.__schedule_refresh(token)
+                except Exception as e:
+                    _LOGGER.debug(f"Ошибка обновления сессии: {e!r}")
+
+        while True:
+            await asyncio.sleep(SESSION_REFRESH_CHECK)
+
+            now = time.time()
+            due = [
+                (token, yandex) for token, yandex in list(self.sessions.items())
+                if token in self.active_tokens and self.session_refresh_at.get(token, 0) <= now
+            ]
+            await asyncio.gather(*[refresh(t, y) for t, y in due])
+
+    def __schedule_refresh(self, token: str):
+        jitter = random.uniform(1 - SESSION_REFRESH_JITTER, 1)
+        self.session_refresh_at[token] = time.time() + SESSION_REFRESH_INTERVAL * jitter
+
+    async def __get_session(self, token: str) -> YandexSession:
+        yandex = self.sessions.get(token)
+        if yandex:
+            return yandex
+
+        # параллельные запросы одного пользователя ждут один логин
+        return await self.login_flight.do(token, lambda: self.__login_session(token))
+
+    async def __login_session(self, token: str) -> YandexSession:
+        with span('login'):
+            return await self.__login_session_once(token)
+
+    async def __login_session_once(self, token: str) -> YandexSession:
+        # у каждого пользователя свои cookies, TCP-соединения общие
+        session = create_session(self.connector)
+        key = session_key(token)
+        saved = self.session_store.get(key)
+
+        if saved:
+            # сохранённые cookies проверятся первым же запросом: на 401
+            # сессия сама перелогинится через refresh_cookies
+            yandex = YandexSession(session, x_token=token,
+                                   music_token=saved.get('music_token'),
+                                   cookie=saved.get('cookie'))
+            yandex.add_update_listener(self.__session_saver(key))
+        else:
+            yandex = YandexSession(session, x_token=token)
+            yandex.add_update_listener(self.__session_saver(key))
+            if not await yandex.login_token(token):
+                await session.close()
+                raise RuntimeError("Login with token failed")
+            # noinspection PyProtectedMember
+            await yandex._handle_update()
+
+        yandex.ws_session = self.ws_session
+        self.sessions[token] = yandex
+        if saved and time.time() - saved.get('saved_at', 0) > SESSION_COOKIES_MAX_AGE:
+            # старые cookies ещё работают, но меняем их в фоне сразу
+            self.session_refresh_at[token] = 0
+        else:
+            self.__schedule_refresh(token)
+        return yandex
+
+    def stats(self) -> dict:
+        return {
+            'active_users': len(self.active_tokens),
+            'sessions': len(self.sessions),
+            'pool': self.pool_stats.snapshot(),
+            'admission': self.admission.snapshot(),
+            'device_actions': self.coalescer.stats(),
+            'reminders': len(self.scheduler) if self.scheduler else 0,
+        }
+
+    def __session_saver(self, key: str):
+        async def save(x_token: str, music_token: str, cookie: str):
+            with self.store_lock:
+                self.session_store[key] = {'music_token': music_token, 'cookie': cookie,
+                                           'saved_at': time.time()}
+        return save
+
+    def forget(self, token: str):
+        """Удаляет всё, что клиент помнит о пользователе."""
+        asyncio.run_coroutine_threadsafe(bind(self.__forget(token)), self.loop).result()
+
+    async def __forget(self, token: str):
+        # иначе фоновый опрос залогинит пользователя снова и сохранит сессию
+        self.active_tokens.pop(token, None)
+        for key, (subscriber_token, _) in list(self.state_subscribers.items()):
+            if subscriber_token == token:
+                self.__unsubscribe_state(key)
+
+        self.invalidate_speakers(token)
+        await self.__close_session(token)
+        with self.store_lock:
+            self.session_store.pop(session_key(token), None)
+
+    async def __close_session(self, token: str):
+        self.session_refresh_at.pop(token, None)
+        for glagol in self.glagols.pop(token, {}).values():
+            await glagol.stop()
+        yandex = self.sessions.pop(token, None)
+        if yandex:
+            await yandex.session.close()
 
     def get_token(self, username: str, password: str) -> str:
         r = self.__get_token_async(username, password)
-        return asyncio.run_coroutine_threadsafe(r, self.loop).result()
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
 
     async def __get_token_async(self, username: str, password: str) -> str:
-        yandex = YandexSession(self.session)
-        response = await yandex.login_username(username, password)
+        session = create_session(self.connector)
+        try:
+            yandex = YandexSession(session)
+            response = await yandex.login_username(username, password)
+        finally:
+            await session.close()
 
         return self.__check_login_response(response)
 
     def get_token_captcha(self, username: str, password: str, captcha: str, track_id: str) -> str:
         r = self.__get_token_captcha_async(username, password, captcha, track_id)
-        return asyncio.run_coroutine_threadsafe(r, self.loop).result()
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
 
     async def __get_token_captcha_async(self, username: str, password: str, captcha: str, track_id: str) -> str:
-        yandex = YandexSession(self.session)
-        response = await yandex.login_captcha(captcha, password, username, track_id)
+        session = create_session(self.connector)
+        try:
+            yandex = YandexSession(session)
+            response = await yandex.login_captcha(captcha, password, username, track_id)
+        finally:
+            await session.close()
 
         return self.__check_login_response(response)
 
@@ -98,50 +457,433 @@ class SyncCloudClient:
             raise RuntimeError("Unknown error")
 
     def get_speakers(self, token: str) -> List[SpeakerConfig]:
-        r = self.__get_speakers_async(token)
-        return asyncio.run_coroutine_threadsafe(r, self.loop).result()
+        """Список колонок из кэша. Устаревший кэш отдаётся сразу, а свежий
+        список загружается в фоне, см. get_speakers_update.
+        """
+        r = self.__get_speakers_cached(token)
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
+
+    def get_speakers_update(self, token: str, shown: List[SpeakerConfig]) -> concurrent.futures.Future:
+        """Future с новым списком колонок после фонового обновления или
+        None, если показанный список не изменился.
+        """
+        r = self.__get_speakers_update_async(token, shown)
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    async def __get_speakers_update_async(self, token: str, shown: List[SpeakerConfig]) -> Optional[List[SpeakerConfig]]:
+        fut = self.speakers_flight.get(token)
+        if fut is not None:
+            try:
+                await asyncio.shield(fut)
+            except Exception:
+                return None
+
+        cached = self.speakers_cache.get(token)
+        if cached is None or cached[1] == shown:
+            return None
+        return cached[1]
+
+    def invalidate_speakers(self, token: str):
+        self.speakers_cache.pop(token, None)
+
+    async def __get_speakers_cached(self, token: str) -> List[SpeakerConfig]:
+        self.__touch(token)
+        cached = self.speakers_cache.get(token)
+        if cached:
+            age = time.time() - cached[0]
+            if age < SPEAKERS_TTL:
+                return cached[1]
+            if age < SPEAKERS_STALE_TTL:
+                # повторные вызовы во время загрузки ждут тот же запрос
+                self.speakers_flight.start(token, lambda: self.__fetch_speakers(token))
+                return cached[1]
+
+        return await self.speakers_flight.do(token, lambda: self.__fetch_speakers(token))
+
+    async def __fetch_speakers(self, token: str) -> List[SpeakerConfig]:
+        speakers = await self.__get_speakers_async(token)
+        self.speakers_cache[token] = (time.time(), speakers)
+        return speakers
 
     async def __get_speakers_async(self, token: str) -> List[SpeakerConfig]:
         quasar = await self.__get_quasar(token)
         await quasar.load_devices()
-
-        return [
-            SpeakerConfig(item['id'], item['name'], item['scenario_id'], item['quasar_info']['device_id'])
-            for item in quasar.speakers
-        ]
+        local = {d['device_id']: d for d in await quasar.load_local_speakers() or []}
+
+        speakers = []
+        for item in quasar.speakers:
+            device_id = item['quasar_info']['device_id']
+            network = local.get(device_id, {})
+            speakers.append(SpeakerConfig(
+                item['id'], item['name'], item['scenario_id'], device_id,
+                item['quasar_info'].get('platform'), network.get('host'), network.get('port')
+            ))
+        return speakers
 
     def prepare_speaker(self, token: str, speaker: SpeakerConfig) -> SpeakerConfig:
         r = self.__prepare_speaker_async(token, speaker)
-        return asyncio.run_coroutine_threadsafe(r, self.loop).result()
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
 
     async def __prepare_speaker_async(self, token: str, speaker: SpeakerConfig) -> SpeakerConfig:
         quasar = await self.__get_quasar(token)
         speaker_data = self.__convert_speaker_config_to_quasar_object(speaker)
         
         await quasar.prepare_speaker(speaker_data)
-        
-        return SpeakerConfig(
-            speaker_data['id'], 
-            speaker_data['name'], 
-            speaker_data['scenario_id'],
-            speaker_data['quasar_info']['device_id']
-        )
 
-    def say(self, token: str, device: SpeakerConfig, phrase: str):
-        r = self.say_async(token, device, phrase)
-        asyncio.run_coroutine_threadsafe(r, self.loop).result()
+        return replace(speaker, scenario_id=speaker_data['scenario_id'])
+
+    def say(self, token: str, device: SpeakerConfig, phrase: str, key: str = None):
+        """With a key and an outbox the phrase is journaled first, so it is
+        delivered after a restart and a repeated key is spoken only once.
+        """
+        if self.outbox and key:
+            r = self.__say_durable(token, device, phrase, key)
+        else:
+            r = self.say_async(token, device, phrase)
+        asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
+
+    def submit_say(self, token: str, device: SpeakerConfig, phrase: str,
+                   user: str, key: str = None) -> concurrent.futures.Future:
+        """Non-blocking say. Phrases of one user are spoken in order; raises
+        UserBusyException at once if the user or the whole bot has too many
+        pending phrases.
+        """
+        if not self.admission.try_acquire(user):
+            raise UserBusyException("Too many pending phrases")
+
+        if self.outbox and key:
+            r = self.__admitted(user, 'say', lambda: self.__say_durable(token, device, phrase, key))
+        else:
+            r = self.__admitted(user, 'say', lambda: self.say_async(token, device, phrase))
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    def submit_broadcast(self, token: str, speakers: List[SpeakerConfig], phrase: str,
+                         user: str) -> concurrent.futures.Future:
+        """Non-blocking broadcast, counted in the same per-user limits as
+        submit_say. Raises UserBusyException at once when they are reached.
+        """
+        if not self.admission.try_acquire(user):
+            raise UserBusyException("Too many pending phrases")
+
+        r = self.__admitted(user, 'broadcast', lambda: self.broadcast_async(token, speakers, phrase))
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    def __get_say_semaphore(self) -> asyncio.Semaphore:
+        if self.say_semaphore is None:
+            self.say_semaphore = asyncio.Semaphore(SAY_CONCURRENCY)
+        return self.say_semaphore
+
+    async def __admitted(self, user: str, name: str, action: Callable[[], Awaitable]):
+        lock = self.user_locks.setdefault(user, asyncio.Lock())
+        queued_at = time.monotonic()
+        try:
+            # один пользователь занимает не больше одного слота
+            async with lock, self.__get_say_semaphore():
+                with span(name, queued=time.monotonic() - queued_at):
+                    await action()
+        finally:
+            if not self.admission.release(user):
+                self.user_locks.pop(user, None)
+
+    async def __say_durable(self, token: str, speaker: SpeakerConfig, phrase: str, key: str):
+        if not self.outbox.add(key, token, asdict(speaker), phrase):
+            _LOGGER.debug(f"Фраза {key} уже принята")
+            return
+        await self.__deliver(key, token, speaker, phrase)
 
+    async def __deliver(self, key: str, token: str, speaker: SpeakerConfig, phrase: str):
+        self.delivering.add(key)
+        try:
+            await self.say_async(token, speaker, phrase)
+        except (SpeakerOfflineException, PhraseTooLongException):
+            self.outbox.drop(key)
+            raise
+        except Exception:
+            self.outbox.failed(key)
+            raise
+        finally:
+            self.delivering.discard(key)
+        self.outbox.done(key)
+
+    async def __replay_outbox(self):
+        while True:
+            try:
+                await self.__retry_outbox()
+            except Exception as e:
+                _LOGGER.warning(f"Ошибка повтора фраз: {e!r}")
+            await asyncio.sleep(OUTBOX_RETRY_INTERVAL)
+
+    async def __retry_outbox(self):
+        # фразы, которые ещё в доставке, не трогаем, иначе скажем их дважды
+        items = [
+            item for item in self.outbox.pending(OUTBOX_MAX_AGE, OUTBOX_MAX_ATTEMPTS)
+            if item.key not in self.delivering
+        ]
+        if items:
+            _LOGGER.info(f"Повторяем {len(items)} недоставленных фраз")
+
+        for item in items:
+            try:
+                await self.__deliver(item.key, item.token, SpeakerConfig(**item.speaker), item.phrase)
+            except Exception as e:
+                _LOGGER.warning(f"Фраза {item.key} не доставлена: {e!r}")
+
+        self.outbox.vacuum(OUTBOX_KEEP)
+
+
+    def add_reminder(self, user: str, due: float, repeat: float, phrase: str) -> Job:
+        """Schedules a phrase at the unix time due, repeated every repeat
+        seconds if repeat is not 0. Raises ValueError if the user has too
+        many reminders.
+        """
+        if self.jobs.count(user) >= REMINDERS_PER_USER:
+            raise ValueError("Too many reminders")
+
+        job = self.jobs.add(user, due, repeat, phrase)
+        self.loop.call_soon_threadsafe(self.scheduler.push, job)
+        return job
+
+    def reminders(self, user: str) -> List[Job]:
+        return self.jobs.user_jobs(user)
+
+    def cancel_reminder(self, user: str, job_id: int) -> bool:
+        if not self.jobs.remove(user, job_id):
+            return False
+        self.loop.call_soon_threadsafe(self.scheduler.discard, job_id)
+        return True
+
+    async def __deliver_reminders(self, jobs: List[Job]):
+        async def deliver(job: Job):
+            target = self.resolve_user(job.user) if self.resolve_user else None
+            if target is None:
+                _LOGGER.debug(f"Напоминание {job.id}: колонка не выбрана")
+                return
+
+            token, speaker = target
+            try:
+                async with self.__get_say_semaphore():
+                    await self.say_async(token, speaker, job.phrase)
+            except Exception as e:
+                _LOGGER.warning(f"Напоминание {job.id} не доставлено: {e!r}")
+
+        await asyncio.gather(*[deliver(job) for job in jobs])
+
+    @staticmethod
+    def __split_phrase(phrase: str) -> List[str]:
+        chunks = split_cloud_text(phrase)
+        if len(chunks) > SAY_MAX_CHUNKS:
+            raise PhraseTooLongException(f"Больше {SAY_MAX_CHUNKS} частей по 100 символов")
+        return chunks
+
+    @staticmethod
+    async def __pause_after(chunk: str):
+        await asyncio.sleep(len(chunk) / TTS_CHARS_PER_SECOND)
 
     async def say_async(self, token: str, speaker: SpeakerConfig, phrase: str):
-        phrase = fix_cloud_text(phrase)
-        if len(phrase) > 100:
-            raise EXCEPTION_100
-        
+        chunks = self.__split_phrase(phrase)
+        if not chunks:
+            return
+
+        self.__touch(token)
+        # колонка точно не в сети - не тратим время на облако
+        if self.__is_offline(speaker.device_id):
+            raise SpeakerOfflineException(f"{speaker.name} is offline")
+
         quasar = await self.__get_quasar(token)
         speaker_data = self.__convert_speaker_config_to_quasar_object(speaker)
 
-        await quasar.send(speaker_data, phrase, is_tts=True)
-        return
+        for i, chunk in enumerate(chunks):
+            if i:
+                await self.__pause_after(chunks[i - 1])
+            with span('quasar.send', device=speaker.device_id):
+                await quasar.send(speaker_data, chunk, is_tts=True)
+        # сценарий мог быть пересоздан
+        speaker.scenario_id = speaker_data['scenario_id']
+
+    @staticmethod
+    def is_media_link(text: str) -> bool:
+        return match_media(text) is not None
+
+    def play_media(self, token: str, speaker: SpeakerConfig, text: str) -> concurrent.futures.Future:
+        """Non-blocking play of a YouTube, Kinopoisk, Yandex Music or VK link.
+        The future fails with MediaNotSupportedException without a local
+        Glagol connection to the station, with ValueError for an unknown link
+        and with StationNotReachableException if the station did not answer.
+        """
+        r = self.play_media_async(token, speaker, text)
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    async def play_media_async(self, token: str, speaker: SpeakerConfig, text: str):
+        self.__touch(token)
+        yandex = await self.__get_session(token)
+        payload = await get_media_payload(text, yandex)
+        if payload is None:
+            raise ValueError("Unknown media link")
+
+        glagol = await self.__get_glagol(token, speaker)
+        if glagol is None:
+            raise MediaNotSupportedException(f"{speaker.name} is not reachable locally")
+
+        if await glagol.send(payload) is None:
+            raise StationNotReachableException(f"{speaker.name} did not answer")
+
+    async def __get_glagol(self, token: str, speaker: SpeakerConfig) -> Optional['YandexGlagol']:
+        from .yandex_glagol import YandexGlagol
+
+        if not speaker.host or not speaker.platform:
+            return None
+
+        glagols = self.glagols.setdefault(token, {})
+        glagol = glagols.get(speaker.device_id)
+        created = glagol is None
+        if created:
+            glagol = glagols[speaker.device_id] = YandexGlagol(await self.__get_session(token), {
+                'name': speaker.name,
+                'host': speaker.host,
+                'port': speaker.port or 1961,
+                'quasar_info': {'device_id': speaker.device_id, 'platform': speaker.platform},
+            })
+            glagol.update_handler = self.__state_fanout(speaker.device_id)
+        else:
+            glagol.device['host'] = speaker.host
+
+        # при неудаче подключение само переподключается в фоне, а мы
+        # ждём только первую попытку
+        try:
+            await asyncio.wait_for(asyncio.shield(glagol.start_or_restart()), GLAGOL_CONNECT_TIMEOUT)
+        except Exception as e:
+            _LOGGER.debug(f"Нет локального подключения к {speaker.name}: {e!r}")
+        if glagol.ws is None or glagol.ws.closed:
+            if created:
+                # иначе переподключение крутится в фоне, хотя оно никому
+                # не нужно, а следующий вызов начнёт с нуля
+                await glagol.stop()
+                glagols.pop(speaker.device_id, None)
+            return None
+        return glagol
+
+    def subscribe_state(self, token: str, speaker: SpeakerConfig, key: Hashable,
+                        callback: Callable[[Optional[dict]], None]):
+        """Calls callback(data) in the asyncio thread for every state frame
+        of the station, and callback(None) when it goes offline. One callback
+        per key, a new subscription with the same key replaces the old one.
+        Raises StationNotReachableException without a local connection.
+        """
+        r = self.__subscribe_state(token, speaker, key, callback)
+        asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
+
+    async def __subscribe_state(self, token: str, speaker: SpeakerConfig, key: Hashable,
+                                callback: Callable[[Optional[dict]], None]):
+        self.__touch(token)
+        if await self.__get_glagol(token, speaker) is None:
+            raise StationNotReachableException(f"{speaker.name} is not reachable locally")
+
+        self.__unsubscribe_state(key)
+        self.state_listeners.setdefault(speaker.device_id, {})[key] = callback
+        self.state_subscribers[key] = (token, speaker.device_id)
+
+    def unsubscribe_state(self, key: Hashable):
+        self.loop.call_soon_threadsafe(self.__unsubscribe_state, key)
+
+    def __unsubscribe_state(self, key: Hashable):
+        _, device_id = self.state_subscribers.pop(key, (None, None))
+        listeners = self.state_listeners.get(device_id)
+        if listeners:
+            listeners.pop(key, None)
+            if not listeners:
+                del self.state_listeners[device_id]
+
+    def __state_fanout(self, device_id: str):
+        async def handler(data: Optional[dict]):
+            for callback in list(self.state_listeners.get(device_id, {}).values()):
+                try:
+                    callback(data)
+                except Exception as e:
+                    _LOGGER.debug(f"Ошибка подписчика {device_id}: {e!r}")
+        return handler
+
+    def device_action(self, token: str, speaker: SpeakerConfig, actions: Actions) -> concurrent.futures.Future:
+        """Non-blocking device control, actions are name -> (value, relative),
+        e.g. {'volume': (2, True), 'mute': (False, False)}. Rapid calls for
+        one station collapse into one request with the final state; all of
+        them get its result.
+        """
+        r = self.coalescer.submit(
+            ('action', speaker.id), actions, merge_actions,
+            lambda merged: self.__apply_actions(token, speaker, merged)
+        )
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    async def __apply_actions(self, token: str, speaker: SpeakerConfig, actions: Actions):
+        # volume +2 и -2 взаимно уничтожаются
+        actions = {k: v for k, v in actions.items() if not (v[1] and v[0] == 0)}
+
+        # флаг relative у device_action один на запрос, но касается только
+        # громкости и канала, остальное уходит в любую группу
+        groups: Dict[bool, dict] = {}
+        other = {}
+        for name, (value, relative) in actions.items():
+            if name in RELATIVE_INSTANCES:
+                groups.setdefault(relative, {})[name] = value
+            else:
+                other[name] = value
+        if other:
+            kwargs = next(iter(groups.values())) if groups else groups.setdefault(False, {})
+            kwargs.update(other)
+
+        if groups:
+            self.__touch(token)
+            quasar = await self.__get_quasar(token)
+            for relative, kwargs in groups.items():
+                with span('quasar.device_action', device=speaker.device_id):
+                    await quasar.device_action(speaker.id, relative=relative, **kwargs)
+
+    def update_device_config(self, token: str, speaker: SpeakerConfig, changes: dict) -> concurrent.futures.Future:
+        """Non-blocking config edit, changes are merged into the station
+        config. The future result is False if nothing had to be changed.
+        """
+        r = self.coalescer.submit(
+            ('config', speaker.id), changes, merge_config,
+            lambda merged: self.__apply_config(token, speaker, merged)
+        )
+        return asyncio.run_coroutine_threadsafe(bind(r), self.loop)
+
+    async def __apply_config(self, token: str, speaker: SpeakerConfig, changes: dict) -> bool:
+        self.__touch(token)
+        quasar = await self.__get_quasar(token)
+        device = {'quasar_info': {'device_id': speaker.device_id, 'platform': speaker.platform}}
+
+        config = await quasar.get_device_config(device)
+        # разделы, которых ещё нет в конфиге, дополняем значениями по умолчанию
+        base = {k: CONFIG_DEFAULTS[k] for k in changes
+                if k in CONFIG_DEFAULTS and k not in config}
+        merged = merge_config(merge_config(config, base), changes)
+        if merged == config:
+            return False
+
+        await quasar.set_device_config(device, merged)
+        return True
+
+    def broadcast(self, token: str, speakers: List[SpeakerConfig], phrase: str):
+        r = self.broadcast_async(token, speakers, phrase)
+        asyncio.run_coroutine_threadsafe(bind(r), self.loop).result()
+
+    async def broadcast_async(self, token: str, speakers: List[SpeakerConfig], phrase: str):
+        chunks = self.__split_phrase(phrase)
+        if not chunks:
+            return
+
+        self.__touch(token)
+        speakers = [s for s in speakers if not self.__is_offline(s.device_id)]
+        if not speakers:
+            raise SpeakerOfflineException("All speakers are offline")
+
+        quasar = await self.__get_quasar(token)
+        devices = [self.__convert_speaker_config_to_quasar_object(s) for s in speakers]
+        for i, chunk in enumerate(chunks):
+            if i:
+                await self.__pause_after(chunks[i - 1])
+            await quasar.send_broadcast(devices, chunk, is_tts=True)
 
     def __convert_speaker_config_to_quasar_object(self, speaker: SpeakerConfig) -> dict:
         return {
@@ -152,9 +894,6 @@ class SyncCloudClient:
         }
     
     async def __get_quasar(self, token: str) -> YandexQuasar:
-        yandex = YandexSession(self.session, x_token = token)
-        quasar = YandexQuasar(yandex)
-        await yandex.login_token(token)
-
-        return quasar
+        yandex = await self.__get_session(token)
+        return YandexQuasar(yandex, self.scenario_registry)
 
@@ -0,0 +1,152 @@
+import json
+import logging
+import queue
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Awaitable, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+# спаны пишутся отдельным логгером, чтобы не смешиваться с обычным логом
+_EXPORT = logging.getLogger(__name__ + '.export')
+_EXPORT.propagate = False
+
+_current: ContextVar[Optional['Span']] = ContextVar('trace_span', default=None)
+
+sample_rate = 0.0
+_listener: Optional[QueueListener] = None
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'attrs')
+
+    def __init__(self, trace_id: str, name: str, parent_id: str = None,
+                 **attrs):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self):
+        _EXPORT.info(json.dumps({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': time.time() - self.start,
+            **self.attrs,
+        }, ensure_ascii=False, default=str))
+
+
+class _NoopSpan:
+    """Спан вне выбранной трассы: ничего не пишет и ничего не стоит."""
+
+    def set(self, **attrs):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def configure(path: str, rate: float, max_bytes: int = 10 << 20,
+              backups: int = 5):
+    """Включает запись трасс в path (JSONL с ротацией). Трасса пишется
+    целиком для доли rate запросов, решение принимается в её начале.
+    Файл пишет отдельный поток, цикл asyncio на диск не ждёт.
+    """
+    global sample_rate, _listener
+
+    sample_rate = rate
+    if rate <= 0 or _listener:
+        return
+
+    handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                  backupCount=backups, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    q = queue.Queue(-1)
+    _EXPORT.addHandler(QueueHandler(q))
+    _EXPORT.setLevel(logging.INFO)
+    _listener = QueueListener(q, handler)
+    _listener.start()
+    _LOGGER.debug(f"Трассировка {rate:.0%} запросов в {path}")
+
+
+def shutdown():
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def start_trace(name: str, **attrs):
+    """Начинает трассу в текущем контексте, если она попала в выборку.
+    Возвращает корневой спан, его нужно закрыть через end_trace.
+    """
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        _current.set(None)
+        return NOOP_SPAN
+
+    root = Span(uuid.uuid4().hex, name, **attrs)
+    _current.set(root)
+    return root
+
+
+def end_trace():
+    root = _current.get()
+    if root:
+        _current.set(None)
+        root.end()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current.get()
+    return span.trace_id if span else None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(parent.trace_id, name, parent.span_id, **attrs)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set(error=repr(e))
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def bind(coro: Awaitable) -> Awaitable:
+    """Переносит трассу текущего потока в корутину, которую запустят в
+    цикле asyncio другого потока (run_coroutine_threadsafe).
+    """
+    parent = _current.get()
+    if parent is None:
+        return coro
+
+    async def run():
+        # у задачи свой контекст, сбрасывать не нужно
+        _current.set(parent)
+        return await coro
+
+    return run()
+
@@ -1,12 +1,16 @@
-import json
 import logging
 import os
 import re
-import uuid
-from datetime import datetime
-from logging import Logger
+import unicodedata
+from functools import lru_cache
+from typing import Awaitable, Callable, List, Match, Optional
+
+from aiohttp import ClientSession
+from cachetools import TTLCache
+
+from .single_flight import SingleFlight
+from .yandex_session import search_stream
 
-from aiohttp import web, ClientSession
 _LOGGER = logging.getLogger(__name__)
 
 # remove uiid, IP
@@ -86,95 +90,202 @@ def play_video_by_descriptor(provider: str, item_id: str):
     }
 
 
-RE_MEDIA = {
-    'youtube': re.compile(
-        r'https://(?:youtu\.be/|www\.youtube\.com/.+?v=)([0-9A-Za-z_-]{11})'),
-    'kinopoisk': re.compile(r'https://hd\.kinopoisk\.ru/.*([0-9a-z]{32})'),
-    'strm': re.compile(r'https://yandex.ru/efir\?.*stream_id=([^&]+)'),
-    'music.yandex.playlist': re.compile(
-        r'https://music\.yandex\.[a-z]+/users/(.+?)/playlists/(\d+)'),
-    'music.yandex': re.compile(
-        r'https://music\.yandex\.[a-z]+/.*(artist|track|album)/(\d+)'),
-    'kinopoisk.id': re.compile(r'https?://www\.kinopoisk\.ru/film/(\d+)/'),
-    'yavideo': re.compile(
-        r'(https?://ok\.ru/video/\d+|https?://vk.com/video-?[0-9_]+)'),
-    'vk': re.compile(r'https://vk\.com/.*(video-?[0-9_]+)'),
-}
+# все ссылки одним выражением: текст просматривается один раз, а тип
+# ссылки определяется по имени последней сработавшей группы
+RE_MEDIA = re.compile(
+    r'https?://(?:'
+    r'(?:youtu\.be/|www\.youtube\.com/.+?v=)(?P<youtube>[0-9A-Za-z_-]{11})|'
+    r'hd\.kinopoisk\.ru/.*(?P<kinopoisk>[0-9a-z]{32})|'
+    r'yandex\.ru/efir\?.*stream_id=(?P<strm>[^&]+)|'
+    r'music\.yandex\.[a-z]+/users/(?P<music_user>.+?)/playlists/'
+    r'(?P<music_playlist>\d+)|'
+    r'music\.yandex\.[a-z]+/.*(?P<music_type>artist|track|album)/'
+    r'(?P<music_id>\d+)|'
+    r'www\.kinopoisk\.ru/film/(?P<kinopoisk_id>\d+)/|'
+    r'(?P<yavideo>ok\.ru/video/\d+|vk\.com/video-?[0-9_]+)|'
+    r'vk\.com/.*(?P<vk>video-?[0-9_]+)'
+    r')'
+)
+RE_MUSIC_UID = re.compile(r'"uid":"(\d+)",')
+
+# username -> uid и kpFilmId -> uuid почти не меняются
+LOOKUP_CACHE = TTLCache(maxsize=1024, ttl=24 * 3600)
+LOOKUP_FLIGHT = SingleFlight()
+
+
+async def cached_lookup(key: tuple, fetch: Callable[[], Awaitable]):
+    """Значение из кэша, а при промахе - один запрос на все одновременные
+    вызовы с этим ключом. Неудачи (None) не кэшируются.
+    """
+    try:
+        return LOOKUP_CACHE[key]
+    except KeyError:
+        pass
+
+    async def load():
+        value = await fetch()
+        if value is not None:
+            LOOKUP_CACHE[key] = value
+        return value
+
+    return await LOOKUP_FLIGHT.do(key, load)
+
+
+def match_media(text: str) -> Optional[Match]:
+    return RE_MEDIA.search(text)
 
 
 async def get_media_payload(text: str, session):
-    for k, v in RE_MEDIA.items():
-        m = v.search(text)
-        if m:
-            if k in ('youtube', 'kinopoisk', 'strm', 'yavideo'):
-                return play_video_by_descriptor(k, m[1])
-
-            elif k == 'vk':
-                url = 'https://vk.com/' + m[1]
-                return play_video_by_descriptor('yavideo', url)
-
-            elif k == 'music.yandex.playlist':
-                uid = await get_userid_v2(session, m[1])
-                if uid:
-                    return {
-                        'command': 'playMusic',
-                        'type': 'playlist',
-                        'id': f"{uid}:{m[2]}",
-                    }
+    m = match_media(text)
+    if not m:
+        return None
 
-            elif k == 'music.yandex':
-                return {
-                    'command': 'playMusic',
-                    'type': m[1],
-                    'id': m[2],
-                }
+    k = m.lastgroup
+    if k in ('youtube', 'kinopoisk', 'strm'):
+        return play_video_by_descriptor(k, m[k])
+
+    elif k == 'yavideo':
+        return play_video_by_descriptor(k, m[0])
+
+    elif k == 'vk':
+        url = 'https://vk.com/' + m[k]
+        return play_video_by_descriptor('yavideo', url)
+
+    elif k == 'music_playlist':
+        username = m['music_user']
+        uid = await cached_lookup(
+            ('uid', username), lambda: get_userid_v2(session, username))
+        if uid:
+            return {
+                'command': 'playMusic',
+                'type': 'playlist',
+                'id': f"{uid}:{m['music_playlist']}",
+            }
 
-            elif k == 'kinopoisk.id':
-                try:
-                    r = await session.get(
-                        'https://ott-widget.kinopoisk.ru/ott/api/'
-                        'kp-film-status/', params={'kpFilmId': m[1]})
-                    resp = await r.json()
-                    return play_video_by_descriptor('kinopoisk', resp['uuid'])
+    elif k == 'music_id':
+        return {
+            'command': 'playMusic',
+            'type': m['music_type'],
+            'id': m['music_id'],
+        }
 
-                except:
-                    return None
+    elif k == 'kinopoisk_id':
+        film_id = m[k]
+        uuid_ = await cached_lookup(
+            ('kinopoisk', film_id), lambda: get_kinopoisk_uuid(session, film_id))
+        if uuid_:
+            return play_video_by_descriptor('kinopoisk', uuid_)
 
     return None
 
 
+async def get_kinopoisk_uuid(session, film_id: str) -> Optional[str]:
+    try:
+        r = await session.get(
+            'https://ott-widget.kinopoisk.ru/ott/api/kp-film-status/',
+            params={'kpFilmId': film_id})
+        resp = await r.json()
+        return resp['uuid']
+    except Exception:
+        return None
 
 
-RE_ID3 = re.compile(br'(Text|TIT2)(....)\x00\x00\x03(.+?)\x00',
-                    flags=re.DOTALL)
+# ID3-тег лежит в начале файла, сам звук не качаем
+ID3_PROBE_SIZE = 4096
+ID3_MAX_SIZE = 1 << 20
+ID3_TEXT_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+
+def id3_tag_size(header: bytes) -> Optional[int]:
+    """Размер тега без 10 байт заголовка или None, если это не ID3v2."""
+    if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (3, 4):
+        return None
+    return synchsafe(header[6:10])
+
+
+def synchsafe(data: bytes) -> int:
+    # в каждом байте значимы только 7 младших бит
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def iter_id3_frames(tag: bytes, version: int):
+    """Отдаёт (id, тело) фреймов тега. В ID3v2.4 размер фрейма synchsafe,
+    в ID3v2.3 - обычное число.
+    """
+    pos = 0
+    while pos + 10 <= len(tag):
+        frame_id = tag[pos:pos + 4]
+        if frame_id == b'\x00\x00\x00\x00':
+            # дальше padding
+            return
+
+        raw_size = tag[pos + 4:pos + 8]
+        size = synchsafe(raw_size) if version == 4 else \
+            int.from_bytes(raw_size, 'big')
+        body = tag[pos + 10:pos + 10 + size]
+        if len(body) < size:
+            return
+
+        yield frame_id, body
+        pos += 10 + size
+
+
+def decode_text_frame(body: bytes) -> Optional[str]:
+    if not body or body[0] >= len(ID3_TEXT_ENCODINGS):
+        return None
+    text = body[1:].decode(ID3_TEXT_ENCODINGS[body[0]], errors='replace')
+    return text.rstrip('\x00')
+
+
+def get_tts_from_id3(tag: bytes, version: int) -> Optional[str]:
+    frames = [
+        (frame_id, body) for frame_id, body in iter_id3_frames(tag, version)
+        if frame_id in (b'TIT2', b'Text')
+    ]
+    if len(frames) == 1 and frames[0][0] == b'TIT2':
+        # old Hass version has valid ID3 tags with `TIT2` for Title
+        _LOGGER.debug(f"Получение TTS из ID3")
+        return decode_text_frame(frames[0][1])
+    elif len(frames) == 3 and frames[2][0] == b'Text':
+        # latest Hass version has bug with `Text` for all tags
+        # there are 3 tags and the last one we need
+        _LOGGER.debug(f"Получение TTS из битого ID3")
+        return decode_text_frame(frames[2][1])
+
+    _LOGGER.debug(f"Невозможно получить TTS: {frames}")
+    return None
 
 
 async def get_tts_message(session: ClientSession, url: str):
-    """Текст сообщения записывается в файл в виде ID3-тегов. Нужно скачать файл
-    и прочитать этот тег. В старых версиях ХА валидный ID3-тег, а в новых -
-    битый.
+    """Текст сообщения записывается в файл в виде ID3-тегов. Читаем только
+    заголовок и сам тег: сначала просим первые ID3_PROBE_SIZE байт через
+    Range, а если тег длиннее - докачиваем остаток тега. В старых версиях
+    ХА валидный ID3-тег, а в новых - битый.
     """
     try:
-        r = await session.get(url, ssl=False)
-        data = await r.read()
-
-        m = RE_ID3.findall(data)
-        if len(m) == 1 and m[0][0] == b'TIT2':
-            # old Hass version has valid ID3 tags with `TIT2` for Title
-            _LOGGER.debug(f"Получение TTS из ID3")
-            m = m[0]
-        elif len(m) == 3 and m[2][0] == b'Text':
-            # latest Hass version has bug with `Text` for all tags
-            # there are 3 tags and the last one we need
-            _LOGGER.debug(f"Получение TTS из битого ID3")
-            m = m[2]
-        else:
-            _LOGGER.debug(f"Невозможно получить TTS: {data}")
-            return None
-
-        # check tag value length
-        if int.from_bytes(m[1], 'big') - 2 == len(m[2]):
-            return m[2].decode('utf-8')
+        r = await session.get(url, ssl=False, headers={
+            'Range': f"bytes=0-{ID3_PROBE_SIZE - 1}"})
+        try:
+            header = await r.content.readexactly(10)
+            size = id3_tag_size(header)
+            if size is None or size > ID3_MAX_SIZE:
+                _LOGGER.debug(f"Невозможно получить TTS: {header}")
+                return None
+
+            if r.status == 206 and 10 + size > ID3_PROBE_SIZE:
+                r.close()
+                r = await session.get(url, ssl=False, headers={
+                    'Range': f"bytes=10-{9 + size}"})
+                if r.status != 206:
+                    # сервер отдал файл целиком, пропускаем заголовок
+                    await r.content.readexactly(10)
+
+            tag = await r.content.readexactly(size)
+        finally:
+            # остаток файла не дочитываем
+            r.close()
+
+        return get_tts_from_id3(tag, header[3])
 
     except:
         _LOGGER.exception("Ошибка получения сообщения TTS")
@@ -182,9 +293,131 @@ async def get_tts_message(session: ClientSession, url: str):
     return None
 
 
-
-RE_CLOUD_TEXT = re.compile(r'(<.+?>|[^А-Яа-яЁёA-Za-z0-9-,!.:=? ]+)')
+CLOUD_TEXT_LIMIT = 100
+CLOUD_ALLOWED = set(
+    'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    '-,!.:=? '
+)
+# символы, которые нельзя отправить, но жалко терять
+CLOUD_REPLACE = {
+    '%': ' процентов ', '‰': ' промилле ', '+': ' плюс ', '&': ' и ',
+    '@': ' собака ', '#': ' номер ', '№': ' номер ', '$': ' долларов ',
+    '€': ' евро ', '£': ' фунтов ', '₽': ' рублей ', '°': ' градусов ',
+    '<': ' меньше ', '>': ' больше ', '×': ' на ', '÷': ' разделить на ',
+    '…': '...', '–': '-', '—': '-', '−': '-', ';': ',', '¿': '', '¡': '',
+    'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE', 'ø': 'o',
+    'Ø': 'O', 'ł': 'l', 'Ł': 'L', 'đ': 'd', 'Đ': 'D', 'þ': 'th',
+    # украинские и белорусские буквы
+    'і': 'и', 'І': 'И', 'ї': 'йи', 'Ї': 'Йи', 'є': 'е', 'Є': 'Е',
+    'ґ': 'г', 'Ґ': 'Г', 'ў': 'у', 'Ў': 'У',
+}
+RE_CLOUD_TAG = re.compile(r'<[^<>]+?>')
+# всё, что нельзя отправить как есть; обычный текст проходит одним
+# сканированием, а таблица применяется только к найденным кускам
+RE_CLOUD_OTHER = re.compile(r'[^А-Яа-яЁёA-Za-z0-9,!.:=? -]+')
 RE_CLOUD_SPACE = re.compile(r'  +')
+# точка между цифрами - дробь, а не конец предложения
+RE_CLOUD_SENTENCE_END = re.compile(r'[!?]|(?<!\d)\.|\.(?!\d)')
+# дальше от limit конец предложения не ищем, чтобы не терять текст
+CLOUD_SENTENCE_WINDOW = 30
+
+
+class CloudTextTable(dict):
+    """Таблица для str.translate, которая заполняется при первой встрече
+    символа, поэтому unicodedata дёргается один раз на символ.
+    """
+
+    def __missing__(self, code: int):
+        value = self[code] = self.convert(chr(code))
+        return value
+
+    @staticmethod
+    def convert(ch: str) -> str:
+        if ch in CLOUD_ALLOWED:
+            return ch
+        if ch in CLOUD_REPLACE:
+            return CLOUD_REPLACE[ch]
+        if ch.isspace():
+            return ' '
+
+        # é -> e, ² -> 2, полноширинные буквы -> обычные
+        plain = ''.join(
+            c for c in unicodedata.normalize('NFKD', ch)
+            if not unicodedata.combining(c)
+        )
+        if plain and plain != ch and all(c in CLOUD_ALLOWED for c in plain):
+            return plain
+
+        # эмодзи, кавычки, скобки и прочее не отправить, но и слова по
+        # обе стороны склеивать нельзя
+        return ' '
+
+
+class CloudRunTable(dict):
+    """Готовые замены для целых кусков вроде ' — ' или '°C': в сообщениях
+    они повторяются, и словарь быстрее, чем translate на каждый кусок.
+    """
+
+    def __init__(self, table: CloudTextTable, maxsize: int = 4096):
+        super().__init__()
+        self.table = table
+        self.maxsize = maxsize
+
+    def __missing__(self, run: str) -> str:
+        value = run.translate(self.table)
+        if len(self) < self.maxsize:
+            self[run] = value
+        return value
+
+
+CLOUD_TABLE = CloudTextTable()
+CLOUD_RUNS = CloudRunTable(CLOUD_TABLE)
+
+
+def _translate_cloud_match(m: Match) -> str:
+    return CLOUD_RUNS[m[0]]
+
+
+@lru_cache(maxsize=1024)
+def normalize_cloud_text(text: str) -> str:
+    """Приводит текст к символам, которые принимает облако, без обрезки."""
+    if '<' in text:
+        # разметку вроде <speaker audio=...> выкидываем целиком
+        text = RE_CLOUD_TAG.sub(' ', text)
+    text = RE_CLOUD_OTHER.sub(_translate_cloud_match, text)
+    if '  ' in text:
+        text = RE_CLOUD_SPACE.sub(' ', text)
+    return text.strip()
+
+
+def _cloud_cut(text: str, limit: int) -> int:
+    """Где резать: конец предложения недалеко от limit, иначе пробел, иначе
+    ровно limit.
+    """
+    cut = -1
+    start = max(0, limit - CLOUD_SENTENCE_WINDOW)
+    # endpos на символ дальше, чтобы точка на limit - 1 видела следующую цифру
+    for m in RE_CLOUD_SENTENCE_END.finditer(text, start, limit + 1):
+        if m.start() < limit:
+            cut = m.start()
+    if cut >= 0:
+        return cut + 1
+    cut = text.rfind(' ', 0, limit + 1)
+    return cut if cut > 0 else limit
+
+
+def split_cloud_text(text: str, limit: int = CLOUD_TEXT_LIMIT) -> List[str]:
+    """Режет длинное сообщение на команды не длиннее limit."""
+    text = normalize_cloud_text(text)
+    chunks = []
+    while len(text) > limit:
+        cut = _cloud_cut(text, limit)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
 
 
 def fix_cloud_text(text: str) -> str:
@@ -194,10 +427,10 @@ def fix_cloud_text(text: str) -> str:
     2. Команда Алисе должна быть не длиннее 100 символов
     3. Нельзя использовать 2 пробела подряд (PS: что с ними не так?!)
     """
-    text = text.strip()
-    text = RE_CLOUD_TEXT.sub('', text)
-    text = RE_CLOUD_SPACE.sub(' ', text)
-    return text[:100]
+    text = normalize_cloud_text(text)
+    if len(text) > CLOUD_TEXT_LIMIT:
+        text = text[:_cloud_cut(text, CLOUD_TEXT_LIMIT)].rstrip()
+    return text
 
 
 # https://music.yandex.ru/users/alexey.khit/playlists
@@ -223,8 +456,8 @@ async def get_userid_v2(session: ClientSession, username: str):
     try:
         r = await session.get(
             f"https://music.yandex.ru/users/{username}/playlists")
-        resp = await r.text()
-        return re.search(r'"uid":"(\d+)",', resp)[1]
+        # uid в начале страницы, остальное не качаем
+        return (await search_stream(r, RE_MUSIC_UID))[1]
     except:
         return None
 
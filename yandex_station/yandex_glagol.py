@@ -9,6 +9,7 @@ from typing import Callable, Optional, Dict
 
 from aiohttp import ClientWebSocketResponse, WSMsgType, ClientConnectorError
 
+from .tracing import span
 from .yandex_session import YandexSession
 from zeroconf import ServiceBrowser, Zeroconf, ServiceStateChange
 
@@ -31,6 +32,7 @@ class YandexGlagol:
         self.session = session
         self.device = device
         self.loop = asyncio.get_event_loop()
+        self.waiters = {}
 
     def debug(self, text: str):
         _LOGGER.debug(f"{self.device['name']} | {text}")
@@ -73,15 +75,17 @@ class YandexGlagol:
     async def stop(self):
         self.debug("Останавливаем локальное подключение")
         self.url = None
-        await self.ws.close()
+        if self.ws:
+            await self.ws.close()
 
     async def _connect(self, fails: int):
         self.debug("Локальное подключение")
 
-        if not self.device_token:
-            self.device_token = await self.get_device_token()
-        
         try:
+            # ошибка токена - такая же неудача подключения, как и остальные
+            if not self.device_token:
+                self.device_token = await self.get_device_token()
+
             self.ws = await self.session.ws_connect(self.url, heartbeat=55,
                                                     ssl=False, timeout=10)
 
@@ -105,7 +109,7 @@ class YandexGlagol:
                 assert e.args[0] == "Session is closed", e.args
 
             self.debug(f"Останавливаем подключение: {e}")
-            if not self.ws.closed:
+            if self.ws and not self.ws.closed:
                 await self.ws.close()
             return
 
@@ -126,7 +130,9 @@ class YandexGlagol:
             timeout = 15 * 2 ** min(fails - 1, 5)
             self.debug(f"Таймаут до следующего подключения {timeout}")
             await asyncio.sleep(timeout)
-            asyncio.create_task(self._connect(fails))
+            # могли остановить, пока ждали
+            if self.url:
+                asyncio.create_task(self._connect(fails))
 
     
     async def _process_messages(self):
@@ -158,7 +164,8 @@ class YandexGlagol:
                             _LOGGER.debug(f"Response error: {e}")
 
                     request_id = data.get('requestId')
-                    if request_id in self.waiters:
+                    if request_id in self.waiters and \
+                            not self.waiters[request_id].done():
                         self.waiters[request_id].set_result(response)
                     
                     if self.update_handler:
@@ -213,9 +220,17 @@ class YandexGlagol:
             pass
 
     async def send(self, payload: dict) -> Optional[dict]:
+        with span('glagol.send', command=payload.get('command')) as s:
+            response = await self._send(payload)
+            s.set(answered=response is not None)
+            return response
+
+    async def _send(self, payload: dict) -> Optional[dict]:
         _LOGGER.debug(f"{self.name} => local | {payload}")
 
         request_id = str(uuid.uuid4())
+        # ждём ответ до отправки, иначе быстрая колонка может ответить раньше
+        self.waiters[request_id] = self.loop.create_future()
 
         try:
             await self.ws.send_json({
@@ -225,8 +240,6 @@ class YandexGlagol:
                 'sentTime': int(round(time.time() * 1000)),
             })
 
-            self.waiters[request_id] = self.loop.create_future()
-
             # limit future wait time
             await asyncio.wait_for(self.waiters[request_id], 5)
 
@@ -238,6 +251,7 @@ class YandexGlagol:
             self.waiters.pop(request_id, None)
 
         except Exception as e:
+            self.waiters.pop(request_id, None)
             _LOGGER.error(e)
 
     async def reset_session(self):
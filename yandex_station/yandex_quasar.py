@@ -1,8 +1,9 @@
-import asyncio
+import hashlib
 import logging
 import time
 
-from .yandex_session import YandexSession
+from .scenario_registry import ScenarioRegistry
+from .yandex_session import StatusError, YandexSession
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -28,16 +29,50 @@ IOT_TYPES = {
 MASK_EN = '0123456789abcdef-'
 MASK_RU = 'оеаинтсрвлкмдпуяы'
 
+ENCODE_TABLE = str.maketrans(MASK_EN, MASK_RU)
+DECODE_TABLE = str.maketrans(MASK_RU, MASK_EN)
+
 URL_USER = 'https://iot.quasar.yandex.ru/m/user'
+# флаг relative в device_action влияет только на них
+RELATIVE_INSTANCES = ('volume', 'channel')
+
+# псевдо-UID общего сценария рассылки на несколько колонок аккаунта
+BROADCAST_ID = 'ffffffff-ffff-ffff-ffff-ffffffffffff'
 
 def encode(uid: str) -> str:
     """Кодируем UID в рус. буквы. Яндекс привередливый."""
-    return 'ХА ' + ''.join([MASK_RU[MASK_EN.index(s)] for s in uid])
+    return 'ХА ' + uid.translate(ENCODE_TABLE)
 
 
 def decode(uid: str) -> str:
     """Раскодируем UID из рус.букв."""
-    return ''.join([MASK_EN[MASK_RU.index(s)] for s in uid[3:]])
+    return uid[3:].translate(DECODE_TABLE)
+
+
+def scenario_payload(uid: str, device_ids: list, action: str, text: str):
+    """Сценарий с голосовой командой из UID, выполняющий действие на
+    каждой из колонок.
+    """
+    name = encode(uid)
+    return {
+        'name': name,
+        'icon': 'home',
+        'triggers': [{
+            'type': 'scenario.trigger.voice',
+            'value': name[3:]
+        }],
+        'requested_speaker_capabilities': [],
+        'devices': [{
+            'id': device_id,
+            'capabilities': [{
+                'type': 'devices.capabilities.quasar.server_action',
+                'state': {
+                    'instance': action,
+                    'value': text
+                }
+            }]
+        } for device_id in device_ids]
+    }
 
 
 class YandexQuasar:
@@ -45,8 +80,12 @@ class YandexQuasar:
     devices = []
     online_update_ts = 0
 
-    def __init__(self, session: YandexSession):
+    def __init__(self, session: YandexSession,
+                 registry: ScenarioRegistry = None):
         self.session = session
+        self.registry = registry or ScenarioRegistry()
+        # online status by quasar_info.device_id
+        self.online = {}
 
     @property
     def hass_id(self):
@@ -67,33 +106,51 @@ class YandexQuasar:
         ]
 
     async def load_devices(self):
-        devices, scenarios = await asyncio.gather(
-            self.__fetch_devices(),
-            self.__fetch_scenarios()
-        )
-
+        devices = await self.session.flight.do('devices', self.__fetch_devices)
         speakers = self.get_speakers_from_devices(devices)
 
-        for speaker in speakers:
-            device_id = speaker['id']
-
-            if device_id not in scenarios:
-                await self.__add_scenario(device_id)
-                scenarios = await self.__fetch_scenarios()
+        # список сценариев качаем, только если чего-то нет в реестре
+        missing = [s['id'] for s in speakers if s['id'] not in self.registry]
+        if missing:
+            await self.__sync_scenarios(missing)
 
-            speaker['scenario_id'] = scenarios[device_id]['id']
+        for speaker in speakers:
+            speaker['scenario_id'] = self.registry.get(speaker['id'])
 
         self.devices = devices
     
     async def prepare_speaker(self, speaker): 
         if speaker['scenario_id']:
+            self.registry.set(speaker['id'], speaker['scenario_id'])
             return
-        
+
         speaker_id = speaker['id']
-        await self.__add_scenario(speaker_id)
+        if speaker_id not in self.registry:
+            await self.__sync_scenarios([speaker_id])
+
+        speaker['scenario_id'] = self.registry.get(speaker_id)
+
+    async def __sync_scenarios(self, device_ids: list):
+        """Сверяет реестр с сервером и создаёт недостающие сценарии."""
+        key = ('scenarios', tuple(sorted(device_ids)))
+        await self.session.flight.do(
+            key, lambda: self.__sync_scenarios_once(device_ids))
+
+    async def __sync_scenarios_once(self, device_ids: list):
         scenarios = await self.__fetch_scenarios()
 
-        speaker['scenario_id'] = scenarios[speaker_id]['id']
+        created = False
+        for device_id in device_ids:
+            if device_id not in scenarios:
+                await self.__add_scenario(device_id)
+                created = True
+
+        if created:
+            scenarios = await self.__fetch_scenarios()
+
+        for device_id, scenario in scenarios.items():
+            if device_id != BROADCAST_ID:
+                self.registry.set(device_id, scenario['id'])
 
     async def __fetch_devices(self) -> list:
         _LOGGER.debug("Получение списка устройств.")
@@ -121,28 +178,10 @@ class YandexQuasar:
             if d['name'].startswith('ХА ')
         }
 
-    async def __add_scenario(self, device_id: str):
+    async def __add_scenario(self, device_id: str, device_ids: list = None):
         """Добавляет сценарий-пустышку."""
-        name = encode(device_id)
-        payload = {
-            'name': name,
-            'icon': 'home',
-            'triggers': [{
-                'type': 'scenario.trigger.voice',
-                'value': name[3:]
-            }],
-            'requested_speaker_capabilities': [],
-            'devices': [{
-                'id': device_id,
-                'capabilities': [{
-                    'type': 'devices.capabilities.quasar.server_action',
-                    'state': {
-                        'instance': 'phrase_action',
-                        'value': 'пустышка'
-                    }
-                }]
-            }]
-        }
+        payload = scenario_payload(device_id, device_ids or [device_id],
+                                   'phrase_action', 'пустышка')
         r = await self.session.post(f"{URL_USER}/scenarios", json=payload)
         resp = await r.json()
         assert resp['status'] == 'ok', resp
@@ -193,39 +232,78 @@ class YandexQuasar:
         _LOGGER.debug(f"{device['name']} => cloud | {text}")
 
         action = 'phrase_action' if is_tts else 'text_action'
-        name = encode(device_id)
-        payload = {
-            'name': name,
-            'icon': 'home',
-            'triggers': [{
-                'type': 'scenario.trigger.voice',
-                'value': name[3:]
-            }],
-            'requested_speaker_capabilities': [],
-            'devices': [{
-                'id': device_id,
-                'capabilities': [{
-                    'type': 'devices.capabilities.quasar.server_action',
-                    'state': {
-                        'instance': action,
-                        'value': text
-                    }
-                }]
-            }]
-        }
+        payload = scenario_payload(device_id, [device_id], action, text)
+
+        try:
+            await self.__put_scenario(device['scenario_id'], payload)
+        except (StatusError, AssertionError) as e:
+            if isinstance(e, StatusError) and e.status not in (400, 404):
+                raise
+            # сценарий удалили или он сломан - пересоздаём
+            _LOGGER.debug(f"Сценарий {device['scenario_id']} недоступен: {e}")
+            self.registry.discard(device_id)
+            await self.__sync_scenarios([device_id])
+            device['scenario_id'] = self.registry.get(device_id)
+            await self.__put_scenario(device['scenario_id'], payload)
 
         sid = device['scenario_id']
 
-        r = await self.session.put(f"{URL_USER}/scenarios/{sid}", json=payload)
+        r = await self.session.post(f"{URL_USER}/scenarios/{sid}/actions")
         resp = await r.json()
         assert resp['status'] == 'ok', resp
 
+    async def send_broadcast(self, devices: list, text: str,
+                             is_tts: bool = False):
+        """Запускает команду или TTS сразу на нескольких колонках одним
+        общим сценарием: два запроса вместо двух на каждую колонку.
+        """
+        device_ids = [device['id'] for device in devices]
+        _LOGGER.debug(f"{len(devices)} speakers => cloud | {text}")
+
+        action = 'phrase_action' if is_tts else 'text_action'
+        payload = scenario_payload(BROADCAST_ID, device_ids, action, text)
+
+        key = self.__broadcast_key()
+        sid = self.registry.get(key)
+        if not sid:
+            sid = await self.__sync_broadcast(key, device_ids)
+
+        try:
+            await self.__put_scenario(sid, payload)
+        except (StatusError, AssertionError) as e:
+            if isinstance(e, StatusError) and e.status not in (400, 404):
+                raise
+            _LOGGER.debug(f"Сценарий рассылки {sid} недоступен: {e}")
+            self.registry.discard(key)
+            sid = await self.__sync_broadcast(key, device_ids)
+            await self.__put_scenario(sid, payload)
+
         r = await self.session.post(f"{URL_USER}/scenarios/{sid}/actions")
         resp = await r.json()
         assert resp['status'] == 'ok', resp
 
+    def __broadcast_key(self) -> str:
+        # по одному сценарию рассылки на аккаунт
+        account = hashlib.sha1(str(self.session.x_token).encode()).hexdigest()
+        return f"broadcast:{account[:16]}"
+
+    async def __sync_broadcast(self, key: str, device_ids: list) -> str:
+        scenarios = await self.__fetch_scenarios()
+        if BROADCAST_ID not in scenarios:
+            await self.__add_scenario(BROADCAST_ID, device_ids)
+            scenarios = await self.__fetch_scenarios()
+
+        sid = scenarios[BROADCAST_ID]['id']
+        self.registry.set(key, sid)
+        return sid
+
+    async def __put_scenario(self, sid: str, payload: dict):
+        r = await self.session.put(f"{URL_USER}/scenarios/{sid}", json=payload)
+        resp = await r.json()
+        assert resp['status'] == 'ok', resp
+
     async def load_local_speakers(self):
-        """Загружает список локальных колонок. Не используется."""
+        """Загружает список колонок с адресами в локальной сети."""
         try:
             r = await self.session.get(
                 'https://quasar.yandex.net/glagol/device_list')
@@ -233,7 +311,9 @@ class YandexQuasar:
             return [{
                 'device_id': d['id'],
                 'name': d['name'],
-                'platform': d['platform']
+                'platform': d['platform'],
+                'host': next(iter(d.get('networkInfo', {}).get('ip_addresses') or []), None),
+                'port': d.get('networkInfo', {}).get('external_port'),
             } for d in resp['devices']]
 
         except:
@@ -268,7 +348,11 @@ class YandexQuasar:
         assert resp['status'] == 'ok', resp
         return resp
 
-    async def device_action(self, deviceid: str, **kwargs):
+    async def device_action(self, deviceid: str, relative: bool = True,
+                            **kwargs):
+        """relative относится к volume и channel: изменить на value или
+        выставить value.
+        """
         _LOGGER.debug(f"Device action: {kwargs}")
 
         actions = []
@@ -279,7 +363,7 @@ class YandexQuasar:
             )
             state = (
                 {'instance': k, 'value': v, 'relative': True}
-                if k in ('volume', 'channel')
+                if relative and k in RELATIVE_INSTANCES
                 else {'instance': k, 'value': v}
             )
             actions.append({'type': type_, 'state': state})
@@ -290,9 +374,10 @@ class YandexQuasar:
         resp = await r.json()
         assert resp['status'] == 'ok', resp
 
-    async def update_online_stats(self):
+    async def update_online_stats(self) -> dict:
+        """Обновляет статус онлайн всех колонок аккаунта одним запросом."""
         if time.time() < self.online_update_ts:
-            return
+            return self.online
 
         _LOGGER.debug(f"Update speakers online status")
 
@@ -303,10 +388,14 @@ class YandexQuasar:
         resp = await r.json()
         assert resp['status'] == 'ok', resp
 
+        index = {
+            p['quasar_info']['device_id']: p
+            for p in self.devices if 'quasar_info' in p
+        }
         for speaker in resp['items']:
-            device = next(
-                p for p in self.devices
-                if 'quasar_info' in p and
-                p['quasar_info']['device_id'] == speaker['id']
-            )
-            device['online'] = speaker['online']
+            self.online[speaker['id']] = speaker['online']
+            device = index.get(speaker['id'])
+            if device:
+                device['online'] = speaker['online']
+
+        return self.online
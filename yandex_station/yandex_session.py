@@ -1,11 +1,17 @@
 import base64
+import codecs
 import json
 import logging
-import pickle
 import re
-from typing import Union
+import zlib
+from http.cookies import Morsel
+from typing import Pattern, Union
 
-from aiohttp import ClientSession
+from aiohttp import ClientResponse, ClientSession, CookieJar
+from yarl import URL
+
+from .single_flight import SingleFlight
+from .tracing import span
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -14,6 +20,67 @@ HEADERS = {'User-Agent': 'com.yandex.mobile.auth.sdk/7.15.0.715001762'}
 RE_CSRF = re.compile('"csrfToken2":"(.+?)"')
 
 
+async def search_stream(r: ClientResponse, pattern: Pattern,
+                        chunk_size: int = 16384, overlap: int = 512):
+    """Ищет pattern в теле ответа по мере загрузки. Совпадение может
+    попасть на границу кусков: хвост прошлого куска длиной overlap
+    ищется вместе со следующим. Найдя совпадение, сразу закрывает
+    соединение, не дочитывая страницу.
+    """
+    decoder = codecs.getincrementaldecoder(r.charset or 'utf-8')('replace')
+    tail = ''
+    try:
+        async for chunk in r.content.iter_chunked(chunk_size):
+            text = tail + decoder.decode(chunk)
+            m = pattern.search(text)
+            if m:
+                r.close()
+                return m
+            tail = text[-overlap:]
+
+        m = pattern.search(tail + decoder.decode(b'', final=True))
+    finally:
+        r.release()
+    return m
+
+
+class StatusError(Exception):
+    """Неуспешный HTTP-статус после всех повторов."""
+
+    def __init__(self, url: str, status: int):
+        super().__init__(f"{url} return {status} status")
+        self.url = url
+        self.status = status
+
+
+def dump_cookies(jar: CookieJar) -> str:
+    """Компактная сериализация cookies: zlib-сжатый JSON в base64."""
+    # noinspection PyProtectedMember
+    raw = [
+        [domain, m.key, m.value, m.coded_value, m['domain'], m['path'],
+         m['expires'], m['max-age'], bool(m['secure']), bool(m['httponly'])]
+        for domain, cookies in jar._cookies.items()
+        for m in cookies.values()
+    ]
+    data = json.dumps(raw, ensure_ascii=False, separators=(',', ':'))
+    return base64.b64encode(zlib.compress(data.encode())).decode()
+
+
+def load_cookies(jar: CookieJar, cookie: str):
+    raw = json.loads(zlib.decompress(base64.b64decode(cookie)))
+    for (domain, name, value, coded_value, cookie_domain, path, expires,
+         max_age, secure, httponly) in raw:
+        morsel = Morsel()
+        morsel.set(name, value, coded_value)
+        morsel['domain'] = cookie_domain
+        morsel['path'] = path
+        morsel['expires'] = expires
+        morsel['max-age'] = max_age
+        morsel['secure'] = secure
+        morsel['httponly'] = httponly
+        jar.update_cookies({name: morsel}, URL(f"https://{domain}/"))
+
+
 class LoginResponse:
     """"
     status: ok
@@ -83,23 +150,26 @@ class YandexSession:
     music_token = None
     _payload: dict = None
     proxy: str = None
+    # отдельная сессия для вебсокетов, чтобы они не занимали общий пул
+    ws_session: ClientSession = None
 
     def __init__(self, session: ClientSession, x_token: str = None,
                  music_token: str = None, cookie: str = None):
         """
         :param x_token: optional x-token from login_username or login_captcha
         :param music_token: optional token for glagol API
-        :param cookie: optional base64 cookie from last session
+        :param cookie: optional cookie from last session, see `cookie`
         """
         self.session = session
 
         self.x_token = x_token
         self.music_token = music_token
         if cookie:
-            raw = base64.b64decode(cookie)
-            self.session.cookie_jar._cookie = pickle.loads(raw)
+            load_cookies(self.session.cookie_jar, cookie)
 
         self._update_listeners = []
+        # одновременные обновления токенов и cookies идут одним запросом
+        self.flight = SingleFlight()
 
     def add_update_listener(self, coro):
         """Listeners to handle automatic cookies update."""
@@ -230,6 +300,10 @@ class YandexSession:
         return True
 
     async def refresh_cookies(self):
+        with span('session.refresh_cookies'):
+            return await self.flight.do('cookies', self._refresh_cookies)
+
+    async def _refresh_cookies(self):
         # check cookies
         r = await self.session.get(
             'https://quasar.yandex.ru/get_account_config')
@@ -239,6 +313,16 @@ class YandexSession:
             return True
 
         # refresh cookies
+        return await self._rotate_cookies()
+
+    async def rotate_cookies(self) -> bool:
+        """New cookies by x-token without checking the current ones, to
+        replace them before they expire.
+        """
+        with span('session.rotate_cookies'):
+            return await self.flight.do('cookies', self._rotate_cookies)
+
+    async def _rotate_cookies(self):
         ok = await self.login_token(self.x_token)
         if ok:
             await self._handle_update()
@@ -262,6 +346,27 @@ class YandexSession:
         assert 'access_token' in resp, resp
         return resp['access_token']
 
+    async def refresh_csrf_token(self):
+        with span('session.refresh_csrf'):
+            await self.flight.do('csrf', self._refresh_csrf_token)
+
+    async def _refresh_csrf_token(self):
+        _LOGGER.debug(f"Обновление CSRF-токена, proxy: {self.proxy}")
+        r = await self.session.get('https://yandex.ru/quasar/iot',
+                                   proxy=self.proxy)
+        m = await search_stream(r, RE_CSRF)
+        assert m, f"csrfToken2 not found, status {r.status}"
+        self.csrf_token = m[1]
+
+    async def refresh_music_token(self):
+        with span('session.refresh_music_token'):
+            await self.flight.do('music', self._refresh_music_token)
+
+    async def _refresh_music_token(self):
+        assert self.x_token, "x-token required"
+        self.music_token = await self.get_music_token(self.x_token)
+        await self._handle_update()
+
     async def get(self, url, **kwargs):
         if '/glagol/' in url:
             return await self._request_glagol(url, **kwargs)
@@ -274,26 +379,23 @@ class YandexSession:
         return await self._request('put', url, **kwargs)
 
     async def ws_connect(self, *args, **kwargs):
-        return await self.session.ws_connect(*args, **kwargs)
+        session = self.ws_session or self.session
+        return await session.ws_connect(*args, **kwargs)
 
     async def _request(self, method: str, url: str, retry: int = 2, **kwargs):
         # all except GET should contain CSRF token
         if method != 'get':
             if self.csrf_token is None:
-                _LOGGER.debug(f"Обновление CSRF-токена, proxy: {self.proxy}")
-                r = await self.session.get('https://yandex.ru/quasar/iot',
-                                           proxy=self.proxy)
-                raw = await r.text()
-                m = RE_CSRF.search(raw)
-                assert m, raw
-                self.csrf_token = m[1]
+                await self.refresh_csrf_token()
 
             kwargs['headers'] = {'x-csrf-token': self.csrf_token}
 
-        r = await getattr(self.session, method)(url, **kwargs)
+        with span('http', method=method, url=str(url).split('?')[0]) as s:
+            r = await getattr(self.session, method)(url, **kwargs)
+            s.set(status=r.status)
         if r.status == 200:
             return r
-        elif r.status == 400:
+        elif r.status in (400, 404):
             retry = 0
         elif r.status == 401:
             # 401 - no cookies
@@ -308,17 +410,17 @@ class YandexSession:
             _LOGGER.debug(f"Retry {method} {url}")
             return await self._request(method, url, retry - 1, **kwargs)
 
-        raise Exception(f"{url} return {r.status} status")
+        raise StatusError(url, r.status)
 
     async def _request_glagol(self, url: str, retry: int = 2, **kwargs):
         # update music token if needed
         if not self.music_token:
-            assert self.x_token, "x-token required"
-            self.music_token = await self.get_music_token(self.x_token)
-            await self._handle_update()
+            await self.refresh_music_token()
 
         headers = {'Authorization': f"Oauth {self.music_token}"}
-        r = await self.session.get(url, headers=headers, **kwargs)
+        with span('http', method='get', url=str(url).split('?')[0]) as s:
+            r = await self.session.get(url, headers=headers, **kwargs)
+            s.set(status=r.status)
         if r.status == 200:
             return r
         elif r.status == 403:
@@ -329,14 +431,11 @@ class YandexSession:
             _LOGGER.debug(f"Retry {url}")
             return await self._request_glagol(url, retry - 1)
 
-        raise Exception(f"{url} return {r.status} status")
+        raise StatusError(url, r.status)
 
     @property
     def cookie(self):
-        # noinspection PyProtectedMember, PyUnresolvedReferences
-        raw = pickle.dumps(self.session.cookie_jar._cookies,
-                           pickle.HIGHEST_PROTOCOL)
-        return base64.b64encode(raw).decode()
+        return dump_cookies(self.session.cookie_jar)
 
     async def _handle_update(self):
         for coro in self._update_listeners: